@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Cityscapes class names for the 40-class YOLO segmentation dataset
+Index in the tuple is the class ID used in the label files and data.yaml
+"""
+
+CITYSCAPES_NAMES = (
+    'person',
+    'motorcyclegroup',
+    'terrain',
+    'ridergroup',
+    'road',
+    'motorcycle',
+    'building',
+    'truck',
+    'caravan',
+    'license plate',
+    'pole',
+    'vegetation',
+    'dynamic',
+    'cargroup',
+    'polegroup',
+    'train',
+    'bicycle',
+    'truckgroup',
+    'bicyclegroup',
+    'out of roi',
+    'guard rail',
+    'ego vehicle',
+    'rectification border',
+    'sky',
+    'bridge',
+    'wall',
+    'fence',
+    'trailer',
+    'tunnel',
+    'car',
+    'ground',
+    'parking',
+    'traffic sign',
+    'persongroup',
+    'static',
+    'rider',
+    'traffic light',
+    'sidewalk',
+    'bus',
+    'rail track',
+)
+
+# data.yaml style {class_id: name} mapping
+CITYSCAPES_NAMES_DICT = dict(enumerate(CITYSCAPES_NAMES))
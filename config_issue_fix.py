@@ -9,16 +9,61 @@ import yaml
 from pathlib import Path
 import os
 import shutil
+from collections import Counter
+from cityscapes_names import CITYSCAPES_NAMES, CITYSCAPES_NAMES_DICT
+from dataset_utils import IMG_EXTS
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+# Resolved once per run and reused by every step below
+HOME = Path.home()
+CWD = Path.cwd()
+
+def count_by_ext(directory):
+    """Count files in a directory by lower-cased suffix ('.png', '.txt', ...) with a single scan"""
+    counts = Counter()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                counts[os.path.splitext(entry.name)[1].lower()] += 1
+    return counts
+
+def scan_set(directory):
+    """Names of the entries in a directory (empty set when it doesn't exist)"""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except OSError:
+        return set()
+
+def remove_dir(path):
+    """Remove a directory, skipping the recursive rmtree walk when it is already empty"""
+    try:
+        with os.scandir(path) as entries:
+            is_empty = next(entries, None) is None
+    except OSError:
+        return
+    
+    if is_empty:
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+    else:
+        shutil.rmtree(path, ignore_errors=True)
 
 def find_ultralytics_settings():
     """Find and show Ultralytics settings file"""
     print("🔍 Finding Ultralytics settings...")
     
     possible_paths = [
-        Path.home() / "Library" / "Application Support" / "Ultralytics" / "settings.json",  # macOS
-        Path.home() / ".config" / "Ultralytics" / "settings.json",  # Linux
-        Path.home() / "AppData" / "Roaming" / "Ultralytics" / "settings.json",  # Windows
-        Path("~/.ultralytics/settings.json").expanduser(),
+        HOME / "Library" / "Application Support" / "Ultralytics" / "settings.json",  # macOS
+        HOME / ".config" / "Ultralytics" / "settings.json",  # Linux
+        HOME / "AppData" / "Roaming" / "Ultralytics" / "settings.json",  # Windows
+        HOME / ".ultralytics" / "settings.json",
     ]
     
     settings_path = None
@@ -52,9 +97,9 @@ def clear_all_yolo_cache():
     
     # Clear ultralytics cache
     cache_dirs = [
-        Path.home() / ".cache" / "ultralytics",
-        Path.home() / ".ultralytics",
-        Path("~/.cache/yolo").expanduser(),
+        HOME / ".cache" / "ultralytics",
+        HOME / ".ultralytics",
+        HOME / ".cache" / "yolo",
         Path("datasets"),
         Path("runs"),
     ]
@@ -62,19 +107,34 @@ def clear_all_yolo_cache():
     for cache_dir in cache_dirs:
         if cache_dir.exists():
             print(f"Removing: {cache_dir}")
-            shutil.rmtree(cache_dir, ignore_errors=True)
+            remove_dir(cache_dir)
+    
+    # Remove local cache files - only look where YOLO writes them
+    # (e.g. cityscapes/labels/train.cache) instead of walking the whole dataset
+    cache_candidates = [
+        Path("."),
+        Path("cityscapes"),
+        Path("cityscapes/labels"),
+        Path("cityscapes/labels/train"),
+        Path("cityscapes/labels/val"),
+        Path("cityscapes/labels/test"),
+    ]
     
-    # Remove local cache files
-    for cache_file in Path().rglob("*.cache"):
-        cache_file.unlink(missing_ok=True)
-        print(f"Removed cache: {cache_file}")
+    for cache_root in cache_candidates:
+        if not cache_root.is_dir():
+            continue
+        with os.scandir(cache_root) as entries:
+            for entry in entries:
+                if entry.name.endswith(".cache") and entry.is_file():
+                    os.unlink(entry.path)
+                    print(f"Removed cache: {entry.path}")
 
 def create_absolute_data_yaml():
     """Create data.yaml with absolute paths for Cityscapes segmentation structure"""
     print("\n📝 Creating data.yaml with absolute paths for Cityscapes segmentation...")
     
     # Get current directory
-    current_dir = Path.cwd()
+    current_dir = CWD
     print(f"Current directory: {current_dir}")
     
     # Find cityscapes directory
@@ -110,49 +170,8 @@ def create_absolute_data_yaml():
         'train': 'images/train',
         'val': 'images/val',
         'test': 'images/test' if test_img_path.exists() else None,
-        'nc': 40,  # 40 classes for cityscapes segmentation
-        'names': {
-            0: 'person',
-            1: 'motorcyclegroup',
-            2: 'terrain',
-            3: 'ridergroup',
-            4: 'road',
-            5: 'motorcycle',
-            6: 'building',
-            7: 'truck',
-            8: 'caravan',
-            9: 'license plate',
-            10: 'pole',
-            11: 'vegetation',
-            12: 'dynamic',
-            13: 'cargroup',
-            14: 'polegroup',
-            15: 'train',
-            16: 'bicycle',
-            17: 'truckgroup',
-            18: 'bicyclegroup',
-            19: 'out of roi',
-            20: 'guard rail',
-            21: 'ego vehicle',
-            22: 'rectification border',
-            23: 'sky',
-            24: 'bridge',
-            25: 'wall',
-            26: 'fence',
-            27: 'trailer',
-            28: 'tunnel',
-            29: 'car',
-            30: 'ground',
-            31: 'parking',
-            32: 'traffic sign',
-            33: 'persongroup',
-            34: 'static',
-            35: 'rider',
-            36: 'traffic light',
-            37: 'sidewalk',
-            38: 'bus',
-            39: 'rail track'
-        }
+        'nc': len(CITYSCAPES_NAMES),  # 40 classes for cityscapes segmentation
+        'names': CITYSCAPES_NAMES_DICT
     }
     
     # Ensure data directory exists
@@ -162,7 +181,7 @@ def create_absolute_data_yaml():
     # Save absolute path version
     yaml_path = data_dir / "data.yaml"
     with open(yaml_path, 'w') as f:
-        yaml.dump(data_config, f, default_flow_style=False, sort_keys=False)
+        yaml.dump(data_config, f, Dumper=SafeDumper, default_flow_style=False, sort_keys=False)
     
     print(f"✅ Created: {yaml_path}")
     print(f"Absolute path: {cityscapes_dir.absolute()}")
@@ -188,15 +207,14 @@ def create_absolute_data_yaml():
         print(f"{name}: {path} ({'✅' if exists else '❌'})")
         
         if exists:
+            counts = count_by_ext(path)
             if 'images' in name.lower():
                 # Count image files (common formats)
-                img_count = (len(list(path.glob("*.png"))) + 
-                           len(list(path.glob("*.jpg"))) + 
-                           len(list(path.glob("*.jpeg"))))
+                img_count = sum(counts[ext] for ext in IMG_EXTS)
                 print(f"  → {img_count} image files")
             else:
                 # Count label files
-                label_count = len(list(path.glob("*.txt")))
+                label_count = counts['.txt']
                 print(f"  → {label_count} label files")
     
     return yaml_path
@@ -215,9 +233,9 @@ def reset_ultralytics_settings():
         
         # Create clean settings
         clean_settings = {
-            "datasets_dir": str(Path.cwd() / "datasets"),
-            "weights_dir": str(Path.cwd() / "weights"),
-            "runs_dir": str(Path.cwd() / "runs")
+            "datasets_dir": str(CWD / "datasets"),
+            "weights_dir": str(CWD / "weights"),
+            "runs_dir": str(CWD / "runs")
         }
         
         with open(settings_path, 'w') as f:
@@ -243,7 +261,7 @@ def test_training_command():
     command = f"yolo segment train data='{yaml_path.absolute()}' model=yolo11n-seg.pt epochs=1 imgsz=640 batch=2 device=cpu cache=False verbose=True"
     
     print(f"\n💡 Try this segmentation command:")
-    print(f"cd {Path.cwd()}")
+    print(f"cd {CWD}")
     print(command)
     
     # Also show Python version
@@ -258,7 +276,7 @@ def verify_cityscapes_structure():
     """Verify the Cityscapes folder structure"""
     print("\n🏗️ Verifying Cityscapes folder structure...")
     
-    current_dir = Path.cwd()
+    current_dir = CWD
     cityscapes_dir = current_dir / "cityscapes"
     
     expected_structure = [
@@ -271,10 +289,17 @@ def verify_cityscapes_structure():
         "cityscapes/data.yaml"
     ]
     
+    # One directory listing per level instead of a stat per expected path
+    listings = {
+        "cityscapes": scan_set(cityscapes_dir),
+        "cityscapes/images": scan_set(cityscapes_dir / "images"),
+        "cityscapes/labels": scan_set(cityscapes_dir / "labels"),
+    }
+    
     print("Expected structure:")
     for path_str in expected_structure:
-        path = current_dir / path_str
-        exists = path.exists()
+        parent, _, name = path_str.rpartition("/")
+        exists = name in listings[parent]
         print(f"  {path_str} {'✅' if exists else '❌'}")
     
     return cityscapes_dir.exists()
@@ -321,7 +346,7 @@ if __name__ == "__main__":
         print("4. Ready for segmentation training ✅")
         
         print(f"\n⚠️  Make sure you're in the right directory:")
-        print(f"cd {Path.cwd()}")
+        print(f"cd {CWD}")
         
         print(f"\n📁 Your segmentation dataset structure:")
         print("  cityscapes/images/train  → training images")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Helpers shared by the Cityscapes dataset scripts
+"""
+
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+# Image extensions, matched case-insensitively (as ultralytics does)
+IMG_EXTS = ('.png', '.jpg', '.jpeg')
+
+# Canonical YOLO label row, shared by the label checkers so they agree on what is already valid:
+# a class ID, then two or more (x, y) pairs each written as 0, 1, 0.x or 1.0..., single spaces.
+# That is a bbox (4 coords) or a polygon (even number >= 6). Callers still range-check the class ID
+_COORD = r'(?:0|1|0\.\d+|1\.0+)'
+_ROW = rf'(\d+)(?: {_COORD} {_COORD}){{2,}}'
+
+# One row of raw label bytes - group 1 is the class ID
+CANONICAL_LINE = re.compile(_ROW.encode())
+
+# A whole label text of canonical rows (no blank-only lines), and the class ID of each of its rows
+CANONICAL_FILE = re.compile(rf'{_ROW}(?:\n+{_ROW})*', re.ASCII)
+ROW_CLASS_ID = re.compile(r'^\d+', re.MULTILINE | re.ASCII)
+
+# Below this many files a process pool costs more to start than it saves
+PARALLEL_MIN_FILES = 64
+
+def map_parallel(func, items, chunksize=1, initializer=None, initargs=(), min_items=PARALLEL_MIN_FILES):
+    """
+    List of func(item) for every item, in input order
+    Runs in worker processes once there are min_items items, otherwise in this process
+    (initializer(*initargs) is then called here first). The pool is closed before returning
+    """
+    if len(items) < min_items:
+        if initializer is not None:
+            initializer(*initargs)
+        return list(map(func, items))
+    
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=initializer, initargs=initargs) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+def is_image_name(name):
+    """True for a file name ending in one of IMG_EXTS, in any case"""
+    return name.lower().endswith(IMG_EXTS)
+
+def list_images(img_dir):
+    """Map image stem -> [paths] for every png/jpg/jpeg file in img_dir from a single directory scan, each list in IMG_EXTS order"""
+    images = {}
+    with os.scandir(img_dir) as entries:
+        for entry in entries:
+            if is_image_name(entry.name) and entry.is_file():
+                images.setdefault(entry.name.rpartition('.')[0], []).append(Path(entry.path))
+    
+    for paths in images.values():
+        if len(paths) > 1:
+            paths.sort(key=lambda p: IMG_EXTS.index(p.suffix.lower()))
+    return images
+
+def list_labels(label_dir):
+    """Map label stem -> path for every .txt file in label_dir using a single directory scan"""
+    labels = {}
+    with os.scandir(label_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt') and entry.is_file():
+                labels[entry.name[:-4]] = Path(entry.path)
+    return labels
+
+@dataclass
+class SplitIndex:
+    """Images and labels of one split keyed by file stem (None when the directory is missing)"""
+    image_dir: Path
+    label_dir: Path
+    images: dict = None
+    labels: dict = None
+
+@dataclass
+class DatasetIndex:
+    """Directory listings for every split, scanned once and shared by the checks"""
+    train: SplitIndex
+    val: SplitIndex
+    test: SplitIndex
+    
+    @classmethod
+    def build(cls, data_root="cityscapes"):
+        data_root = Path(data_root)
+        splits = {}
+        for split in ['train', 'val', 'test']:
+            split_index = SplitIndex(data_root / 'images' / split, data_root / 'labels' / split)
+            try:
+                split_index.images = list_images(split_index.image_dir)
+            except OSError:
+                pass
+            try:
+                split_index.labels = list_labels(split_index.label_dir)
+            except OSError:
+                pass
+            splits[split] = split_index
+        return cls(**splits)
+    
+    def split(self, name):
+        return getattr(self, name)
+    
+    def find(self, image_dir):
+        """Return the split indexed for image_dir, if any"""
+        image_dir = Path(image_dir).resolve()
+        for split in ['train', 'val', 'test']:
+            split_index = self.split(split)
+            if split_index.image_dir.resolve() == image_dir:
+                return split_index
+        return None
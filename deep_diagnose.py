@@ -4,35 +4,89 @@ Deep YOLO Dataset Diagnostic for Cityscapes Structure
 Find exactly why YOLO isn't recognizing the labels
 """
 
-import os
-import yaml
+import marshal
 from pathlib import Path
-import cv2
+import numpy as np
+from cityscapes_names import CITYSCAPES_NAMES, CITYSCAPES_NAMES_DICT
+from dataset_utils import DatasetIndex, list_images, list_labels
 
-def check_exact_file_matching():
+def yaml_backend():
+    """Import PyYAML on first use, preferring the libyaml C loader/dumper"""
+    import yaml
+    try:
+        from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+    except ImportError:
+        from yaml import SafeLoader, SafeDumper
+    return yaml, SafeLoader, SafeDumper
+
+def load_yaml_cached(path):
+    """
+    Load a YAML file, reusing a marshal cache (.cache/<name>.marshal beside it) while the
+    YAML's mtime and size match the ones it was saved with. marshal keeps int keys
+    (e.g. names) as ints, so a cache hit returns the same data as parsing
+    """
+    path = Path(path)
+    cache_path = path.parent / '.cache' / (path.name + '.marshal')
+    st = path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, data = marshal.load(f)
+        if cached_key == key:
+            return data
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    
+    yaml, SafeLoader, _ = yaml_backend()
+    with open(path, 'r') as f:
+        data = yaml.load(f, Loader=SafeLoader)
+    
+    # Cache is best effort - YAML timestamps and other non-builtin values can't be marshalled
+    try:
+        cache_bytes = marshal.dumps((key, data))
+        cache_path.parent.mkdir(exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            f.write(cache_bytes)
+    except (OSError, ValueError):
+        pass
+    
+    return data
+
+def is_readable_image(img_file):
+    """Check the PNG/JPEG signature instead of decoding the whole image"""
+    try:
+        with open(img_file, 'rb') as f:
+            header = f.read(12)
+    except OSError:
+        return False
+    return header.startswith(b'\x89PNG\r\n\x1a\n') or header.startswith(b'\xff\xd8\xff')
+
+def check_exact_file_matching(index=None):
     """Check exact file name matching between images and labels"""
     print("🔍 EXACT FILE MATCHING CHECK")
     print("=" * 40)
     
+    if index is None:
+        index = DatasetIndex.build()
+    
     for split in ['train', 'val', 'test']:
         print(f"\n📁 {split.upper()} SET:")
         
-        img_dir = Path(f"cityscapes/images/{split}")
-        label_dir = Path(f"cityscapes/labels/{split}")
+        split_index = index.split(split)
+        img_dir = split_index.image_dir
+        label_dir = split_index.label_dir
         
-        if not img_dir.exists() or not label_dir.exists():
+        if split_index.images is None or split_index.labels is None:
             print(f"❌ Missing directories")
             print(f"  Images dir exists: {img_dir.exists()} ({img_dir.absolute()})")
             print(f"  Labels dir exists: {label_dir.exists()} ({label_dir.absolute()})")
             continue
         
         # Get all files (support multiple image formats)
-        img_extensions = ["*.png", "*.jpg", "*.jpeg"]
-        img_files = {}
-        for ext in img_extensions:
-            img_files.update({f.stem: f for f in img_dir.glob(ext)})
+        img_files = split_index.images
         
-        label_files = {f.stem: f for f in label_dir.glob("*.txt")}
+        label_files = split_index.labels
         
         print(f"Images: {len(img_files)}")
         print(f"Labels: {len(label_files)}")
@@ -54,26 +108,26 @@ def check_exact_file_matching():
         # Test a few specific pairs
         print(f"\n🔍 Testing specific file pairs:")
         for stem in list(matched)[:3]:
-            img_file = img_files[stem]
+            img_file = img_files[stem][0]
             label_file = label_files[stem]
             
             # Check if image can be read
-            img = cv2.imread(str(img_file))
-            img_readable = img is not None
+            img_readable = is_readable_image(img_file)
             
             # Check label content
             try:
                 with open(label_file, 'r') as f:
-                    content = f.read().strip()
-                label_valid = bool(content and len(content.split('\n')) > 0)
-                label_lines = len([l for l in content.split('\n') if l.strip()])
+                    content = f.read()
+                lines = [l for l in content.splitlines() if l.strip()]
+                label_valid = bool(lines)
+                label_lines = len(lines)
             except:
                 label_valid = False
                 label_lines = 0
             
             print(f"  {stem}: img_ok={img_readable}, label_ok={label_valid}, objects={label_lines}")
 
-def check_yolo_data_yaml():
+def check_yolo_data_yaml(data=None):
     """Check if data.yaml is correctly formatted"""
     print(f"\n📋 DATA.YAML CHECK")
     print("=" * 20)
@@ -84,8 +138,8 @@ def check_yolo_data_yaml():
         return
     
     try:
-        with open(yaml_path, 'r') as f:
-            data = yaml.safe_load(f)
+        if data is None:
+            data = load_yaml_cached(yaml_path)
         
         print(f"✅ YAML loaded successfully")
         print(f"Path: {data.get('path', 'NOT SET')}")
@@ -117,18 +171,18 @@ def check_yolo_data_yaml():
     except Exception as e:
         print(f"❌ Error reading YAML: {e}")
 
-def simulate_yolo_label_search():
+def simulate_yolo_label_search(data=None, index=None):
     """Simulate how YOLO searches for labels"""
     print(f"\n🔍 SIMULATING YOLO LABEL SEARCH")
     print("=" * 35)
     
     # Load YAML to get paths
-    try:
-        with open("cityscapes/data.yaml", 'r') as f:
-            data = yaml.safe_load(f)
-    except:
-        print("❌ Cannot load cityscapes/data.yaml")
-        return
+    if data is None:
+        try:
+            data = load_yaml_cached("cityscapes/data.yaml")
+        except:
+            print("❌ Cannot load cityscapes/data.yaml")
+            return
     
     base_path = Path(data.get('path', 'cityscapes'))
     
@@ -150,17 +204,18 @@ def simulate_yolo_label_search():
         print(f"Label path exists: {label_path.exists()}")
         
         if label_path.exists():
-            # Test a few files
-            img_extensions = ["*.png", "*.jpg", "*.jpeg"]
-            img_files = []
-            for ext in img_extensions:
-                img_files.extend(list(img_path.glob(ext))[:2])  # Get 2 files per extension
-            
-            img_files = img_files[:3]  # Limit to 3 total files
+            # Test a few files - reuse the shared listing when data.yaml points at an indexed split
+            split_index = index.find(img_path) if index is not None else None
+            if split_index is not None and split_index.images is not None and split_index.labels is not None:
+                img_files = [paths[0] for paths in list(split_index.images.values())[:3]]  # Limit to 3 total files
+                label_stems = split_index.labels
+            else:
+                img_files = [paths[0] for paths in list(list_images(img_path).values())[:3]]  # Limit to 3 total files
+                label_stems = set(list_labels(label_path))
             
             for img_file in img_files:
                 expected_label = label_path / f"{img_file.stem}.txt"
-                label_exists = expected_label.exists()
+                label_exists = img_file.stem in label_stems
                 
                 if label_exists:
                     try:
@@ -177,7 +232,7 @@ def simulate_yolo_label_search():
                 
                 print(f"  {img_file.name} -> {expected_label.name}: exists={label_exists}, content={has_content}, lines={line_count}")
 
-def create_minimal_test_dataset():
+def create_minimal_test_dataset(index=None):
     """Create a minimal test dataset to verify YOLO works"""
     print(f"\n🧪 CREATING MINIMAL TEST DATASET")
     print("=" * 35)
@@ -194,28 +249,28 @@ def create_minimal_test_dataset():
     # Copy a few files from your dataset
     import shutil
     
-    source_train_img = Path("cityscapes/images/train")
-    source_train_labels = Path("cityscapes/labels/train")
+    if index is None:
+        index = DatasetIndex.build()
+    
+    train_index = index.train
+    source_train_img = train_index.image_dir
+    source_train_labels = train_index.label_dir
     
-    if source_train_img.exists() and source_train_labels.exists():
+    if train_index.images is not None and train_index.labels is not None:
         # Copy first 3 files
-        img_extensions = ["*.png", "*.jpg", "*.jpeg"]
-        img_files = []
-        for ext in img_extensions:
-            img_files.extend(list(source_train_img.glob(ext))[:2])
-        
-        img_files = img_files[:3]  # Limit to 3 files
+        img_files = [paths[0] for paths in list(train_index.images.values())[:3]]  # Limit to 3 files
+        label_stems = train_index.labels
         
         copied_count = 0
         for img_file in img_files:
             label_file = source_train_labels / f"{img_file.stem}.txt"
             
-            if label_file.exists():
-                # Copy files
-                shutil.copy2(img_file, test_dir / "images" / "train")
-                shutil.copy2(label_file, test_dir / "labels" / "train")
-                shutil.copy2(img_file, test_dir / "images" / "val") 
-                shutil.copy2(label_file, test_dir / "labels" / "val")
+            if img_file.stem in label_stems:
+                # Copy contents only - metadata doesn't matter for a throwaway dataset
+                shutil.copyfile(img_file, test_dir / "images" / "train" / img_file.name)
+                shutil.copyfile(label_file, test_dir / "labels" / "train" / label_file.name)
+                shutil.copyfile(img_file, test_dir / "images" / "val" / img_file.name)
+                shutil.copyfile(label_file, test_dir / "labels" / "val" / label_file.name)
                 copied_count += 1
         
         if copied_count > 0:
@@ -224,12 +279,13 @@ def create_minimal_test_dataset():
                 'path': str(test_dir.absolute()),
                 'train': 'images/train',
                 'val': 'images/val',
-                'nc': 40,
-                'names': {i: f'class_{i}' for i in range(40)}
+                'nc': len(CITYSCAPES_NAMES),
+                'names': {i: f'class_{i}' for i in range(len(CITYSCAPES_NAMES))}
             }
             
+            yaml, _, SafeDumper = yaml_backend()
             with open(test_dir / "data.yaml", 'w') as f:
-                yaml.dump(test_yaml, f, default_flow_style=False)
+                yaml.dump(test_yaml, f, Dumper=SafeDumper, default_flow_style=False)
             
             print(f"✅ Test dataset created at: {test_dir.absolute()}")
             print(f"Files in train: {len(list((test_dir / 'images' / 'train').glob('*')))}")
@@ -244,20 +300,38 @@ def create_minimal_test_dataset():
         print(f"  Train images: {source_train_img.exists()} ({source_train_img.absolute()})")
         print(f"  Train labels: {source_train_labels.exists()} ({source_train_labels.absolute()})")
 
-def check_label_content_detailed():
+def make_label_validator(nc=len(CITYSCAPES_NAMES)):
+    """Build a (class_id, coords) validator specialised for nc classes"""
+    max_class_id = nc - 1
+    
+    def is_valid(class_id, coords):
+        # min/max are single C reductions - no per-coordinate Python work or temporary masks
+        return bool(0 <= class_id <= max_class_id and
+                    (coords.size == 0 or (coords.min() >= 0.0 and coords.max() <= 1.0)))
+    
+    return is_valid
+
+def check_label_content_detailed(index=None):
     """Check label content in detail"""
     print(f"\n📝 DETAILED LABEL CONTENT CHECK")
     print("=" * 35)
     
+    if index is None:
+        index = DatasetIndex.build()
+    
+    nc = len(CITYSCAPES_NAMES)
+    is_valid = make_label_validator(nc)
+    
     for split in ['train', 'val', 'test']:
-        label_dir = Path(f"cityscapes/labels/{split}")
-        if not label_dir.exists():
+        split_index = index.split(split)
+        label_dir = split_index.label_dir
+        if split_index.labels is None:
             print(f"\n❌ {split.upper()} labels directory doesn't exist: {label_dir.absolute()}")
             continue
             
         print(f"\n{split.upper()} labels:")
         
-        label_files = list(label_dir.glob("*.txt"))
+        label_files = list(split_index.labels.values())
         if not label_files:
             print("❌ No label files found!")
             continue
@@ -290,29 +364,27 @@ def check_label_content_detailed():
                             # Standard bounding box format
                             try:
                                 class_id = int(parts[0])
-                                coords = [float(x) for x in parts[1:]]
-                                valid_format = (0 <= class_id <= 39 and 
-                                              all(0 <= c <= 1 for c in coords))
+                                coords = np.asarray(parts[1:], dtype=np.float64)
+                                valid_format = is_valid(class_id, coords)
                                 print(f"      ✅ Bounding box format - Valid: {valid_format}")
                                 if not valid_format:
-                                    print(f"      Class ID range: {class_id} (should be 0-39)")
-                                    print(f"      Coord ranges: {coords} (should be 0-1)")
+                                    print(f"      Class ID range: {class_id} (should be 0-{nc - 1})")
+                                    print(f"      Coord ranges: {coords.tolist()} (should be 0-1)")
                             except:
                                 print(f"      ❌ Cannot parse numbers")
                         elif len(parts) >= 7 and len(parts) % 2 == 1:
                             # Polygon segmentation format (class_id + pairs of x,y coordinates)
                             try:
                                 class_id = int(parts[0])
-                                coords = [float(x) for x in parts[1:]]
-                                num_points = len(coords) // 2
-                                valid_format = (0 <= class_id <= 39 and 
-                                              all(0 <= c <= 1 for c in coords))
+                                coords = np.asarray(parts[1:], dtype=np.float64)
+                                num_points = coords.size // 2
+                                valid_format = is_valid(class_id, coords)
                                 print(f"      ✅ Polygon segmentation format - {num_points} points - Valid: {valid_format}")
                                 if not valid_format:
-                                    print(f"      Class ID range: {class_id} (should be 0-39)")
-                                    invalid_coords = [c for c in coords if not (0 <= c <= 1)]
-                                    if invalid_coords:
-                                        print(f"      Invalid coordinates (should be 0-1): {invalid_coords[:10]}...")
+                                    print(f"      Class ID range: {class_id} (should be 0-{nc - 1})")
+                                    invalid_coords = coords[(coords < 0) | (coords > 1)]
+                                    if invalid_coords.size:
+                                        print(f"      Invalid coordinates (should be 0-1): {invalid_coords[:10].tolist()}...")
                             except:
                                 print(f"      ❌ Cannot parse numbers")
                         else:
@@ -334,22 +406,14 @@ def create_sample_data_yaml():
         'train': 'images/train',
         'val': 'images/val',
         'test': 'images/test',
-        'nc': 40,  # Number of classes (adjust as needed)
-        'names': {
-            0: 'person', 1: 'motorcyclegroup', 2: 'terrain', 3: 'ridergroup', 4: 'road',
-            5: 'motorcycle', 6: 'building', 7: 'truck', 8: 'caravan', 9: 'license plate',
-            10: 'pole', 11: 'vegetation', 12: 'dynamic', 13: 'cargroup', 14: 'polegroup',
-            15: 'train', 16: 'bicycle', 17: 'truckgroup', 18: 'bicyclegroup', 19: 'out of roi',
-            20: 'guard rail', 21: 'ego vehicle', 22: 'rectification border', 23: 'sky', 24: 'bridge',
-            25: 'wall', 26: 'fence', 27: 'trailer', 28: 'tunnel', 29: 'car',
-            30: 'ground', 31: 'parking', 32: 'traffic sign', 33: 'persongroup', 34: 'static',
-            35: 'rider', 36: 'traffic light', 37: 'sidewalk', 38: 'bus', 39: 'rail track'
-        }
+        'nc': len(CITYSCAPES_NAMES),  # Number of classes (adjust as needed)
+        'names': CITYSCAPES_NAMES_DICT
     }
     
+    yaml, _, SafeDumper = yaml_backend()
     yaml_path = Path("cityscapes/cityscapes_data.yaml")
     with open(yaml_path, 'w') as f:
-        yaml.dump(sample_yaml, f, default_flow_style=False)
+        yaml.dump(sample_yaml, f, Dumper=SafeDumper, default_flow_style=False)
     
     print(f"✅ Sample data.yaml created: {yaml_path.absolute()}")
     print("📝 Content:")
@@ -367,11 +431,20 @@ if __name__ == "__main__":
         print("Please make sure your dataset is in the 'cityscapes' folder")
         exit(1)
     
+    # Parse data.yaml once and share it between the checks
+    try:
+        data = load_yaml_cached("cityscapes/data.yaml")
+    except Exception:
+        data = None
+    
+    # Scan the split directories once and share the listings between the checks
+    index = DatasetIndex.build(cityscapes_dir)
+    
     # Run all checks
-    check_yolo_data_yaml()
-    check_exact_file_matching()
-    simulate_yolo_label_search()
-    check_label_content_detailed()
+    check_yolo_data_yaml(data)
+    check_exact_file_matching(index)
+    simulate_yolo_label_search(data, index)
+    check_label_content_detailed(index)
     
     print(f"\n" + "=" * 50)
     print("OPTIONS:")
@@ -383,7 +456,7 @@ if __name__ == "__main__":
     response = input("Choose option: ").lower().strip()
     
     if response in ['y', 'b']:
-        create_minimal_test_dataset()
+        create_minimal_test_dataset(index)
     
     if response in ['s', 'b']:
         create_sample_data_yaml()
\ No newline at end of file
@@ -6,8 +6,149 @@ Diagnoses issues with YOLO dataset structure and label files
 
 import os
 import glob
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
+import numpy as np
+
+from cityscapes_names import CITYSCAPES_NAMES, CITYSCAPES_NAMES_DICT
+from dataset_utils import IMG_EXTS
+
+@lru_cache(maxsize=None)
+def _listdir(path, suffixes):
+    """
+    Files in path ending with one of suffixes, as os.DirEntry objects from a single scan
+    Cached so the diagnose -> fix -> re-diagnose flow doesn't rescan unchanged directories;
+    call _invalidate_listings() after adding, moving or removing files
+    """
+    with os.scandir(path) as entries:
+        return tuple(e for e in entries
+                     if e.is_file(follow_symlinks=False) and e.name.lower().endswith(suffixes))
+
+def _invalidate_listings():
+    """Forget cached directory listings after the dataset has been changed"""
+    _listdir.cache_clear()
+
+def _list_images(img_dir):
+    """Image files in img_dir as a tuple of os.DirEntry objects (shared with the cache - don't modify)"""
+    return _listdir(str(img_dir), IMG_EXTS)
+
+def _list_labels(label_dir):
+    """Label (.txt) files in label_dir as a tuple of os.DirEntry objects (shared with the cache - don't modify)"""
+    return _listdir(str(label_dir), ('.txt',))
+
+def _stem(entry):
+    """File name without its extension for an os.DirEntry"""
+    return entry.name.rpartition('.')[0]
+
+def _diagnose_split(images_dir, labels_dir, split):
+    """Diagnose one split and return its report text (printed by the caller so output order stays fixed)"""
+    report = []
+    
+    report.append(f"\n📊 {split.upper()} SET:")
+    report.append("-" * 20)
+    
+    img_dir = images_dir / split
+    label_dir = labels_dir / split
+    
+    # Check directories exist
+    report.append(f"Images dir exists: {'✅' if img_dir.exists() else '❌'} {img_dir}")
+    report.append(f"Labels dir exists: {'✅' if label_dir.exists() else '❌'} {label_dir}")
+    
+    if not img_dir.exists():
+        return "\n".join(report)
+        
+    # Count files
+    image_files = _list_images(img_dir)
+    report.append(f"Image files found: {len(image_files)}")
+    
+    if len(image_files) > 0:
+        report.append(f"First few images: {[f.name for f in image_files[:3]]}")
+    
+    if label_dir.exists():
+        label_files = _list_labels(label_dir)
+        report.append(f"Label files found: {len(label_files)}")
+        
+        if len(label_files) > 0:
+            report.append(f"First few labels: {[f.name for f in label_files[:3]]}")
+            
+            # Check matching - stems come straight from the dirent names, no Path objects,
+            # and are matched with sorted-array merges instead of Python sets
+            image_stems = np.unique(np.array([_stem(e) for e in image_files], dtype=str))
+            label_stems = np.unique(np.array([_stem(e) for e in label_files], dtype=str))
+            
+            matched = np.intersect1d(image_stems, label_stems, assume_unique=True).size
+            unmatched_images = np.setdiff1d(image_stems, label_stems, assume_unique=True).tolist()
+            unmatched_labels = np.setdiff1d(label_stems, image_stems, assume_unique=True).tolist()
+            
+            report.append(f"Matched pairs: {matched}")
+            report.append(f"Images without labels: {len(unmatched_images)}")
+            report.append(f"Labels without images: {len(unmatched_labels)}")
+            
+            if len(unmatched_images) > 0:
+                report.append(f"Examples of images without labels: {unmatched_images[:5]}")
+            if len(unmatched_labels) > 0:
+                report.append(f"Examples of labels without images: {unmatched_labels[:5]}")
+            
+            # Check label content
+            if label_files:
+                sample_label = label_files[0]
+                try:
+                    with open(sample_label, 'r') as f:
+                        content = f.read().strip()
+                        if content:
+                            lines = content.split('\n')
+                            report.append(f"Sample label content ({sample_label.name}):")
+                            report.append(f"  Lines: {len(lines)}")
+                            report.append(f"  First line: '{lines[0]}'")
+                            
+                            # Validate format
+                            parts = lines[0].split()
+                            
+                            # Check for bounding box format (5 parts)
+                            if len(parts) == 5:
+                                try:
+                                    class_id = int(parts[0])
+                                    coords = [float(x) for x in parts[1:]]
+                                    report.append(f"  Format: ✅ BBOX - class_id={class_id}, coords={coords}")
+                                    if class_id < 0 or class_id >= len(CITYSCAPES_NAMES):
+                                        report.append(f"  ⚠️  Class ID {class_id} outside valid range (0-{len(CITYSCAPES_NAMES) - 1})")
+                                    if any(c < 0 or c > 1 for c in coords):
+                                        report.append(f"  ⚠️  Coordinates not normalized (should be 0-1)")
+                                except ValueError as e:
+                                    report.append(f"  ❌ Invalid bbox format: {e}")
+                            
+                            # Check for polygon segmentation format (odd number >= 7)
+                            elif len(parts) >= 7 and len(parts) % 2 == 1:
+                                try:
+                                    class_id = int(parts[0])
+                                    coords = [float(x) for x in parts[1:]]
+                                    num_points = len(coords) // 2
+                                    report.append(f"  Format: ✅ POLYGON - class_id={class_id}, points={num_points}")
+                                    if class_id < 0 or class_id >= len(CITYSCAPES_NAMES):
+                                        report.append(f"  ⚠️  Class ID {class_id} outside valid range (0-{len(CITYSCAPES_NAMES) - 1})")
+                                    if any(c < 0 or c > 1 for c in coords):
+                                        report.append(f"  ⚠️  Coordinates not normalized (should be 0-1)")
+                                except ValueError as e:
+                                    report.append(f"  ❌ Invalid polygon format: {e}")
+                            
+                            else:
+                                report.append(f"  ❌ Invalid format: {len(parts)} parts")
+                                report.append(f"      Expected: 5 (bbox) or odd number ≥7 (polygon)")
+                                
+                        else:
+                            report.append(f"  ❌ Empty label file!")
+                except Exception as e:
+                    report.append(f"  ❌ Error reading label: {e}")
+        else:
+            report.append("❌ No label files found!")
+    else:
+        report.append("❌ Labels directory doesn't exist!")
+    
+    return "\n".join(report)
+
 def diagnose_dataset(data_root="cityscapes"):
     """Comprehensive dataset diagnosis for Cityscapes structure"""
     print("🔍 CITYSCAPES YOLO Dataset Diagnostic Report")
@@ -28,110 +169,13 @@ def diagnose_dataset(data_root="cityscapes"):
     print(f"Images root exists: {'✅' if images_dir.exists() else '❌'} {images_dir}")
     print(f"Labels root exists: {'✅' if labels_dir.exists() else '❌'} {labels_dir}")
     
-    # Check train, val, and test directories
-    for split in ['train', 'val', 'test']:
-        print(f"\n📊 {split.upper()} SET:")
-        print("-" * 20)
-        
-        img_dir = images_dir / split
-        label_dir = labels_dir / split
-        
-        # Check directories exist
-        print(f"Images dir exists: {'✅' if img_dir.exists() else '❌'} {img_dir}")
-        print(f"Labels dir exists: {'✅' if label_dir.exists() else '❌'} {label_dir}")
-        
-        if not img_dir.exists():
-            continue
-            
-        # Count files
-        image_files = list(img_dir.glob('*.png')) + list(img_dir.glob('*.jpg')) + list(img_dir.glob('*.jpeg'))
-        print(f"Image files found: {len(image_files)}")
-        
-        if len(image_files) > 0:
-            print(f"First few images: {[f.name for f in image_files[:3]]}")
-        
-        if label_dir.exists():
-            label_files = list(label_dir.glob('*.txt'))
-            print(f"Label files found: {len(label_files)}")
-            
-            if len(label_files) > 0:
-                print(f"First few labels: {[f.name for f in label_files[:3]]}")
-                
-                # Check matching
-                matched = 0
-                unmatched_images = []
-                unmatched_labels = []
-                
-                image_stems = {f.stem for f in image_files}
-                label_stems = {f.stem for f in label_files}
-                
-                matched = len(image_stems & label_stems)
-                unmatched_images = image_stems - label_stems
-                unmatched_labels = label_stems - image_stems
-                
-                print(f"Matched pairs: {matched}")
-                print(f"Images without labels: {len(unmatched_images)}")
-                print(f"Labels without images: {len(unmatched_labels)}")
-                
-                if len(unmatched_images) > 0:
-                    print(f"Examples of images without labels: {list(unmatched_images)[:5]}")
-                if len(unmatched_labels) > 0:
-                    print(f"Examples of labels without images: {list(unmatched_labels)[:5]}")
-                
-                # Check label content
-                if label_files:
-                    sample_label = label_files[0]
-                    try:
-                        with open(sample_label, 'r') as f:
-                            content = f.read().strip()
-                            if content:
-                                lines = content.split('\n')
-                                print(f"Sample label content ({sample_label.name}):")
-                                print(f"  Lines: {len(lines)}")
-                                print(f"  First line: '{lines[0]}'")
-                                
-                                # Validate format
-                                parts = lines[0].split()
-                                
-                                # Check for bounding box format (5 parts)
-                                if len(parts) == 5:
-                                    try:
-                                        class_id = int(parts[0])
-                                        coords = [float(x) for x in parts[1:]]
-                                        print(f"  Format: ✅ BBOX - class_id={class_id}, coords={coords}")
-                                        if class_id < 0 or class_id >= 40:
-                                            print(f"  ⚠️  Class ID {class_id} outside valid range (0-39)")
-                                        if any(c < 0 or c > 1 for c in coords):
-                                            print(f"  ⚠️  Coordinates not normalized (should be 0-1)")
-                                    except ValueError as e:
-                                        print(f"  ❌ Invalid bbox format: {e}")
-                                
-                                # Check for polygon segmentation format (odd number >= 7)
-                                elif len(parts) >= 7 and len(parts) % 2 == 1:
-                                    try:
-                                        class_id = int(parts[0])
-                                        coords = [float(x) for x in parts[1:]]
-                                        num_points = len(coords) // 2
-                                        print(f"  Format: ✅ POLYGON - class_id={class_id}, points={num_points}")
-                                        if class_id < 0 or class_id >= 40:
-                                            print(f"  ⚠️  Class ID {class_id} outside valid range (0-39)")
-                                        if any(c < 0 or c > 1 for c in coords):
-                                            print(f"  ⚠️  Coordinates not normalized (should be 0-1)")
-                                    except ValueError as e:
-                                        print(f"  ❌ Invalid polygon format: {e}")
-                                
-                                else:
-                                    print(f"  ❌ Invalid format: {len(parts)} parts")
-                                    print(f"      Expected: 5 (bbox) or odd number ≥7 (polygon)")
-                                    
-                            else:
-                                print(f"  ❌ Empty label file!")
-                    except Exception as e:
-                        print(f"  ❌ Error reading label: {e}")
-            else:
-                print("❌ No label files found!")
-        else:
-            print("❌ Labels directory doesn't exist!")
+    # Check train, val, and test directories concurrently - the work is directory
+    # scans and small reads, so threads overlap the I/O; map() keeps the report order
+    splits = ['train', 'val', 'test']
+    with ThreadPoolExecutor(max_workers=len(splits)) as executor:
+        reports = executor.map(_diagnose_split, [images_dir] * len(splits), [labels_dir] * len(splits), splits)
+        for report in reports:
+            print(report)
     
     # Check data.yaml
     print(f"\n📋 DATA.YAML CHECK:")
@@ -206,16 +250,19 @@ def fix_common_issues(data_root="cityscapes"):
                             print(f"   ✅ Moved: {label_file.name}")
                         except Exception as e:
                             print(f"   ❌ Failed to move {label_file.name}: {e}")
+    
+    # Label directories may have changed
+    _invalidate_listings()
 
-def create_empty_labels(data_root="cityscapes"):
+def create_empty_labels(data_root="cityscapes", yes=False):
     """Create empty label files for images without labels (for testing)"""
     print("\n⚠️  EMERGENCY FIX: Creating empty labels")
     print("=" * 40)
     print("This creates empty .txt files for images without labels.")
     print("Use this only for testing - you need real annotations for training!")
     
-    response = input("Continue? (y/N): ").lower().strip()
-    if response != 'y':
+    if not yes:
+        print("👋 Skipped - pass --yes to create the empty labels")
         return
     
     data_path = Path(data_root)
@@ -231,20 +278,30 @@ def create_empty_labels(data_root="cityscapes"):
             
         label_dir.mkdir(parents=True, exist_ok=True)
         
-        image_files = (list(img_dir.glob('*.png')) + 
-                      list(img_dir.glob('*.jpg')) + 
-                      list(img_dir.glob('*.jpeg')))
+        image_files = _list_images(img_dir)
         created = 0
         
+        # One directory scan instead of an exists() stat per image
+        with os.scandir(label_dir) as entries:
+            existing = {e.name for e in entries}
+        
         for img_file in image_files:
-            label_file = label_dir / f"{img_file.stem}.txt"
-            if not label_file.exists():
-                label_file.touch()  # Create empty file
+            name = f"{_stem(img_file)}.txt"
+            if name not in existing:
+                # Create empty file - bare open/close, no utime like touch()
+                try:
+                    fd = os.open(os.path.join(label_dir, name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                except FileExistsError:
+                    continue
+                os.close(fd)
+                existing.add(name)
                 created += 1
         
         print(f"Created {created} empty label files in {split}/labels/")
+    
+    _invalidate_listings()
 
-def create_sample_data_yaml(data_root="cityscapes"):
+def create_sample_data_yaml(data_root="cityscapes", overwrite=False):
     """Create a sample data.yaml file for Cityscapes"""
     print("\n📋 CREATING SAMPLE DATA.YAML")
     print("=" * 30)
@@ -252,61 +309,22 @@ def create_sample_data_yaml(data_root="cityscapes"):
     data_path = Path(data_root)
     yaml_file = data_path / 'data.yaml'
     
-    if yaml_file.exists():
-        response = input(f"data.yaml already exists. Overwrite? (y/N): ").lower().strip()
-        if response != 'y':
-            return
+    if yaml_file.exists() and not overwrite:
+        print("👋 data.yaml already exists - pass --yes to overwrite it")
+        return
     
-    yaml_content = f"""# Cityscapes YOLO Dataset Configuration
-path: {data_root}  # dataset root dir
-train: images/train  # train images (relative to 'path')
-val: images/val      # val images (relative to 'path')
-test: images/test    # test images (relative to 'path') [optional]
-
-# Classes (40 classes for Cityscapes)
-nc: 40  # number of classes
-names:
-  0: person
-  1: motorcyclegroup
-  2: terrain
-  3: ridergroup
-  4: road
-  5: motorcycle
-  6: building
-  7: truck
-  8: caravan
-  9: nse plate
-  10: pole
-  11: vegetation
-  12: dynamic
-  13: cargroup
-  14: polegroup
-  15: train
-  16: bicycle
-  17: truckgroup
-  18: bicyclegroup
-  19: out of roi
-  20: guard rail
-  21: ego vehicle
-  22: rectification border
-  23: sky
-  24: bridge
-  25: wall
-  26: fence
-  27: trailer
-  28: tunnel
-  29: car
-  30: ground
-  31: parking
-  32: traffic sign
-  33: persongroup
-  34: static
-  35: rider
-  36: traffic light
-  37: sidewalk
-  38: bus
-  39: rail track
-"""
+    import yaml
+    
+    # Class names come from the shared table instead of a hand-written listing
+    config = {
+        'path': str(data_root),  # dataset root dir
+        'train': 'images/train',  # train images (relative to 'path')
+        'val': 'images/val',
+        'test': 'images/test',  # [optional]
+        'nc': len(CITYSCAPES_NAMES),
+        'names': CITYSCAPES_NAMES_DICT
+    }
+    yaml_content = "# Cityscapes YOLO Dataset Configuration\n" + yaml.safe_dump(config, sort_keys=False)
     
     try:
         with open(yaml_file, 'w') as f:
@@ -316,36 +334,34 @@ names:
         print(f"❌ Failed to create data.yaml: {e}")
 
 if __name__ == "__main__":
-    # Run diagnosis
-    diagnose_dataset()
-    
-    # Offer fixes
-    print("\n" + "=" * 50)
-    print("🛠️  AVAILABLE FIXES:")
-    print("1. Fix common structural issues")
-    print("2. Create empty labels (testing only)")
-    print("3. Create sample data.yaml")
-    print("4. All fixes (1 + 3)")
-    print("5. Exit")
+    parser = argparse.ArgumentParser(description="Diagnose and fix a Cityscapes YOLO dataset")
+    parser.add_argument("--data-root", default="cityscapes", help="dataset root directory")
+    parser.add_argument("--mode", choices=["diagnose", "fix", "empty", "yaml", "all"], default="diagnose",
+                        help="fix: common structural issues, empty: empty labels (testing only), "
+                             "yaml: sample data.yaml, all: fix + yaml")
+    parser.add_argument("--yes", action="store_true",
+                        help="confirm creating empty labels / overwriting an existing data.yaml")
+    args = parser.parse_args()
     
-    choice = input("\nSelect option (1-5): ").strip()
+    # Run diagnosis
+    diagnose_dataset(args.data_root)
     
-    if choice == "1":
-        fix_common_issues()
+    if args.mode == "fix":
+        fix_common_issues(args.data_root)
         print("\n🔄 Re-running diagnosis after fixes...")
-        diagnose_dataset()
-    elif choice == "2":
-        create_empty_labels()
+        diagnose_dataset(args.data_root)
+    elif args.mode == "empty":
+        create_empty_labels(args.data_root, yes=args.yes)
         print("\n🔄 Re-running diagnosis after creating empty labels...")
-        diagnose_dataset()
-    elif choice == "3":
-        create_sample_data_yaml()
+        diagnose_dataset(args.data_root)
+    elif args.mode == "yaml":
+        create_sample_data_yaml(args.data_root, overwrite=args.yes)
         print("\n🔄 Re-running diagnosis after creating data.yaml...")
-        diagnose_dataset()
-    elif choice == "4":
-        fix_common_issues()
-        create_sample_data_yaml()
+        diagnose_dataset(args.data_root)
+    elif args.mode == "all":
+        fix_common_issues(args.data_root)
+        create_sample_data_yaml(args.data_root, overwrite=args.yes)
         print("\n🔄 Re-running diagnosis after all fixes...")
-        diagnose_dataset()
+        diagnose_dataset(args.data_root)
     else:
-        print("👋 Exiting...")
\ No newline at end of file
+        print("\n💡 Run with --mode fix|empty|yaml|all to apply fixes")
@@ -1,19 +1,45 @@
+import gc
+
 import torch
 
-# Load your YOLOv11n-seg model
-model = torch.load('cityscapes_segmentation/train2/weights/best.pt', weights_only=False)['model'].float()
+# Load your YOLOv11n-seg model - mmap the checkpoint so the optimizer/EMA/training state
+# we throw away is never copied onto the heap, then drop everything but the model
+ckpt = torch.load('cityscapes_segmentation/train2/weights/best.pt', map_location='cpu', mmap=True, weights_only=False)
+model = ckpt['model'].float()
+del ckpt
+gc.collect()
 model.eval()
 
+# Export in FP16 when a GPU is available - half the file size and memory bandwidth of an
+# FP32 graph. Tracing (and most CPU runtimes) run FP16 poorly, so CPU-only exports stay FP32
+HALF = torch.cuda.is_available()
+if HALF:
+    model = model.cuda().half()
+
 # Create dummy input tensor (batch size 1, 3 color channels, 640x640 image)
 dummy_input = torch.randn(1, 3, 640, 640)
+if HALF:
+    dummy_input = dummy_input.cuda().half()
 
-# Export model to ONNX
+# Export model to ONNX with a static (1, 3, 640, 640) input so runtimes can specialize kernels
 torch.onnx.export(
     model,
     dummy_input,
     "yolo11n-city-seg.onnx",
     input_names=['input'],
     output_names=['output'],
-    opset_version=12,
-    dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}}
+    opset_version=17,
+    do_constant_folding=True
 )
+
+# Collapse the leftover Shape/Gather/Reshape chains if onnx-simplifier is installed
+try:
+    import onnx
+    import onnxsim
+except ImportError:
+    onnxsim = None
+
+if onnxsim is not None:
+    simplified, ok = onnxsim.simplify(onnx.load("yolo11n-city-seg.onnx"))
+    if ok:
+        onnx.save(simplified, "yolo11n-city-seg.onnx")
@@ -5,28 +5,115 @@ Handles both bbox (5 parts) and polygon segmentation formats
 """
 
 import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
+import numpy as np
+
+from cityscapes_names import CITYSCAPES_NAMES
+from dataset_utils import CANONICAL_LINE, map_parallel
+
+# Files known to be in the correct format, keyed by absolute path -> [mtime_ns, size, "ok"],
+# stored under the dataset root
+FIX_STATE_FILE = Path('.cache') / 'label_fix_state.json'
+
+# Reused read buffer - label files are tiny, so one os.readv fills it without a file object
+_READ_BUF = bytearray(1 << 20)
+
+def _read_label(label_file):
+    """Raw bytes of a label file via os.open/os.readv into the shared buffer"""
+    fd = os.open(label_file, os.O_RDONLY)
+    try:
+        if not hasattr(os, 'readv'):  # Windows
+            return b''.join(iter(lambda: os.read(fd, len(_READ_BUF)), b''))
+        
+        n = os.readv(fd, [_READ_BUF])
+        data = bytes(memoryview(_READ_BUF)[:n])
+        if n == len(_READ_BUF):
+            # Larger than the buffer - read the rest directly
+            data += b''.join(iter(lambda: os.read(fd, len(_READ_BUF)), b''))
+        return data
+    finally:
+        os.close(fd)
+
+def _decode_label(data):
+    """Decode raw label bytes like open(..., 'r') - raises UnicodeDecodeError for non-UTF-8 data"""
+    text = data.decode()
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+def _list_label_files(label_dir):
+    """
+    Label files in label_dir from a single os.scandir pass
+    Cached per directory mtime - fixing rewrites files in place and reuses the listing, while
+    creating, renaming or removing files changes the mtime and forces a rescan
+    """
+    return _scan_label_dir(str(label_dir), os.stat(label_dir).st_mtime_ns)
+
+@lru_cache(maxsize=None)
+def _scan_label_dir(label_dir, mtime_ns):
+    """Uncached listing behind _list_label_files (mtime_ns only keys the cache)"""
+    with os.scandir(label_dir) as entries:
+        return tuple(Path(e.path) for e in entries if e.name.endswith('.txt') and e.is_file())
+
+def parse_annotation(parts):
+    """
+    Parse the tokens of one label line into (class_id, coords)
+    Returns None unless it is a valid bbox (5 parts) or polygon (odd number >= 7) annotation
+    """
+    if not (len(parts) == 5 or (len(parts) >= 7 and len(parts) % 2 == 1)):
+        return None
+    
+    try:
+        class_id = int(parts[0])
+        # Convert all coordinates in one C-level call instead of a float() per token
+        coords = np.asarray(parts[1:], dtype=np.float64)
+    except ValueError:
+        return None
+    
+    # Validate values against the Cityscapes class table
+    if not (0 <= class_id < len(CITYSCAPES_NAMES) and ((coords >= 0) & (coords <= 1)).all()):
+        return None
+    
+    return class_id, coords
+
+# Output rows go through bytes %-formatting (the C printf path) with templates built once
+FMT_BBOX = b"%d %.6f %.6f %.6f %.6f\n"
+
+@lru_cache(maxsize=None)
+def _line_template(num_coords):
+    """Bytes template for one label row with num_coords coordinates"""
+    if num_coords == 4:
+        return FMT_BBOX
+    return b"%d" + b" %.6f" * num_coords + b"\n"
+
 def fix_label_format(label_file):
     """Fix a single label file format"""
     try:
         with open(label_file, 'r') as f:
-            content = f.read().strip()
-        
-        if not content:
-            return False, "Empty file"
-        
-        # Check if file is already in correct format
-        lines = content.split('\n')
-        if len(lines) > 1:
-            # Check first line
-            first_line_parts = lines[0].strip().split()
+            # Check if file is already in correct format - only read as far as
+            # the first annotation line and the start of a second one
+            first_line = next((line for line in f if line.strip()), None)
+            if first_line is None:
+                return False, "Empty file"
+            
+            first_line_parts = first_line.split()
             if len(first_line_parts) == 5 or (len(first_line_parts) >= 7 and len(first_line_parts) % 2 == 1):
-                return True, "Already correct format"
+                if any(line.strip() for line in f):
+                    return True, "Already correct format"
+            
+            # Needs fixing - only now read the whole file
+            f.seek(0)
+            content = f.read().strip()
         
         # Fix the format - split by newlines within the single line
         # The issue is that multiple annotations are on one line separated by \n
-        fixed_lines = []
+        out = bytearray()
+        fixed_count = 0
         
         # Split the content by \n characters (both literal \n and actual newlines)
         all_annotations = content.replace('\\n', '\n').split('\n')
@@ -36,45 +123,50 @@ def fix_label_format(label_file):
             if not annotation_line:
                 continue
                 
-            parts = annotation_line.split()
-            
-            # Handle bounding box format (5 values: class_id x y w h)
-            if len(parts) == 5:
-                try:
-                    class_id = int(parts[0])
-                    coords = [float(x) for x in parts[1:]]
-                    
-                    # Validate values for 40 classes
-                    if 0 <= class_id <= 39 and all(0 <= c <= 1 for c in coords):
-                        fixed_lines.append(f"{class_id} {coords[0]:.6f} {coords[1]:.6f} {coords[2]:.6f} {coords[3]:.6f}")
-                except ValueError:
-                    continue
+            # Handles bbox (class_id x y w h) and polygon (class_id + pairs of x,y) lines
+            parsed = parse_annotation(annotation_line.split())
+            if parsed is None:
+                continue
             
-            # Handle polygon segmentation format (odd number >= 7: class_id + pairs of x,y)
-            elif len(parts) >= 7 and len(parts) % 2 == 1:
-                try:
-                    class_id = int(parts[0])
-                    coords = [float(x) for x in parts[1:]]
-                    
-                    # Validate values for 40 classes
-                    if 0 <= class_id <= 39 and all(0 <= c <= 1 for c in coords):
-                        # Keep original precision for polygon coordinates
-                        coord_str = ' '.join(f"{c:.6f}" for c in coords)
-                        fixed_lines.append(f"{class_id} {coord_str}")
-                except ValueError:
-                    continue
+            class_id, coords = parsed
+            out += _line_template(len(coords)) % (class_id, *coords.tolist())
+            fixed_count += 1
         
-        if fixed_lines:
+        if fixed_count:
             # Write back the corrected format
-            with open(label_file, 'w') as f:
-                f.write('\n'.join(fixed_lines) + '\n')
-            return True, f"Fixed {len(fixed_lines)} annotations"
+            with open(label_file, 'wb') as f:
+                f.write(out)
+            return True, f"Fixed {fixed_count} annotations"
         else:
             return False, "No valid annotations found"
             
     except Exception as e:
         return False, f"Error: {e}"
 
+def _load_fix_state(state_file):
+    """Load the saved per-file fix state, or an empty one if there is none"""
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_fix_state(state, state_file):
+    """Write the per-file fix state (via a temp file so an interrupted run can't corrupt it)"""
+    try:
+        state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = state_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, state_file)
+    except OSError as e:
+        print(f"⚠️  Could not save label fix state: {e}")
+
+def _fix_state_entry(label_file):
+    """Current [mtime_ns, size, "ok"] entry for a label file"""
+    st = os.stat(label_file)
+    return [st.st_mtime_ns, st.st_size, "ok"]
+
 def fix_all_labels(data_root="cityscapes"):
     """Fix all label files in the dataset"""
     print("🔧 Fixing Cityscapes YOLO label format")
@@ -94,26 +186,69 @@ def fix_all_labels(data_root="cityscapes"):
         'empty': 0
     }
     
-    for split in ['train', 'val', 'test']:
+    # Collect every split first so all files share one worker pool; the split
+    # listings are independent directory scans, so they run on threads
+    def list_split(split):
+        label_dir = labels_dir / split
+        return list(_list_label_files(label_dir)) if label_dir.exists() else None
+    
+    splits = ['train', 'val', 'test']
+    with ThreadPoolExecutor(max_workers=len(splits)) as executor:
+        split_files = dict(zip(splits, executor.map(list_split, splits)))
+    
+    # Files unchanged since a previous run found them correct are skipped without reading.
+    # Entries are keyed by absolute path (each split directory is resolved once) and the
+    # saved state only keeps files listed in this run, so removed files drop out
+    state_file = data_path / FIX_STATE_FILE
+    saved_state = _load_fix_state(state_file)
+    state = {}
+    keys = {}
+    entries = {}
+    unchanged = set()
+    for split, label_files in split_files.items():
+        label_dir = str((labels_dir / split).resolve())
+        for label_file in label_files or ():
+            key = keys[label_file] = os.path.join(label_dir, label_file.name)
+            try:
+                entries[key] = _fix_state_entry(label_file)
+            except OSError:
+                continue
+            if saved_state.get(key) == entries[key]:
+                unchanged.add(label_file)
+                state[key] = entries[key]
+    
+    all_files = [f for label_files in split_files.values() if label_files for f in label_files if f not in unchanged]
+    results = iter(map_parallel(fix_label_format, all_files, chunksize=64))
+    
+    for split, label_files in split_files.items():
         print(f"\n📁 Processing {split.upper()} set...")
         
-        label_dir = labels_dir / split
-        if not label_dir.exists():
-            print(f"❌ Labels directory not found: {label_dir}")
+        if label_files is None:
+            print(f"❌ Labels directory not found: {labels_dir / split}")
             continue
         
-        label_files = list(label_dir.glob('*.txt'))
         print(f"Found {len(label_files)} label files")
         
         for label_file in label_files:
-            success, message = fix_label_format(label_file)
+            if label_file in unchanged:
+                stats['already_correct'] += 1
+                continue
+            
+            success, message = next(results)
+            key = keys[label_file]
             
             if success:
                 if "Already correct" in message:
                     stats['already_correct'] += 1
+                    if key in entries:
+                        state[key] = entries[key]
                 else:
                     stats['fixed'] += 1
                     print(f"✅ {label_file.name}: {message}")
+                    try:
+                        state[key] = _fix_state_entry(label_file)  # rewritten, so stat again
+                    except OSError:
+                        pass
             else:
                 if "Empty file" in message:
                     stats['empty'] += 1
@@ -122,6 +257,8 @@ def fix_all_labels(data_root="cityscapes"):
                     stats['errors'] += 1
                     print(f"❌ {label_file.name}: {message}")
     
+    _save_fix_state(state, state_file)
+    
     print(f"\n📊 SUMMARY:")
     print(f"Fixed: {stats['fixed']}")
     print(f"Already correct: {stats['already_correct']}")
@@ -146,7 +283,7 @@ def verify_fixed_format(data_root="cityscapes"):
             print(f"❌ {split.upper()} labels directory not found")
             continue
         
-        label_files = list(label_dir.glob('*.txt'))
+        label_files = list(_list_label_files(label_dir))
         valid_files = 0
         total_objects = 0
         bbox_count = 0
@@ -154,53 +291,45 @@ def verify_fixed_format(data_root="cityscapes"):
         
         for label_file in label_files:
             try:
-                with open(label_file, 'r') as f:
-                    lines = f.readlines()
+                data = _read_label(label_file)
                 
-                if not lines:
+                if not data:
                     continue
                 
+                # Non-ASCII files must still fail to decode up front, as text mode did
+                if not data.isascii():
+                    data.decode()
+                
                 file_valid = True
                 file_objects = 0
                 
-                for line in lines:
-                    line = line.strip()
+                for raw_line in data.splitlines():
+                    # Fast path: lines already in the canonical format need no parsing
+                    match = CANONICAL_LINE.fullmatch(raw_line)
+                    if match and int(match[1]) < len(CITYSCAPES_NAMES):
+                        file_objects += 1
+                        if raw_line.count(b' ') == 4:
+                            bbox_count += 1
+                        else:
+                            polygon_count += 1
+                        continue
+                    
+                    line = raw_line.decode().strip()
                     if not line:
                         continue
                         
                     parts = line.split()
                     
-                    # Check bounding box format (5 parts)
-                    if len(parts) == 5:
-                        try:
-                            class_id = int(parts[0])
-                            coords = [float(x) for x in parts[1:]]
-                            if not (0 <= class_id <= 39) or not all(0 <= c <= 1 for c in coords):
-                                file_valid = False
-                                break
-                            file_objects += 1
-                            bbox_count += 1
-                        except ValueError:
-                            file_valid = False
-                            break
-                    
-                    # Check polygon segmentation format (odd number >= 7)
-                    elif len(parts) >= 7 and len(parts) % 2 == 1:
-                        try:
-                            class_id = int(parts[0])
-                            coords = [float(x) for x in parts[1:]]
-                            if not (0 <= class_id <= 39) or not all(0 <= c <= 1 for c in coords):
-                                file_valid = False
-                                break
-                            file_objects += 1
-                            polygon_count += 1
-                        except ValueError:
-                            file_valid = False
-                            break
-                    
-                    else:
+                    # Bounding box (5 parts) or polygon segmentation (odd number >= 7)
+                    if parse_annotation(parts) is None:
                         file_valid = False
                         break
+                    
+                    file_objects += 1
+                    if len(parts) == 5:
+                        bbox_count += 1
+                    else:
+                        polygon_count += 1
                 
                 if file_valid and file_objects > 0:
                     valid_files += 1
@@ -269,6 +398,31 @@ def manual_fix_example():
 5 0.566406 0.373047 0.597656 0.390625"""
     print(f"'{example_correct_poly}'")
 
+# Byte lookup tables matching str.split() whitespace and universal-newline line breaks (ASCII)
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[list(b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f')] = True
+_LINE_BREAK = np.zeros(256, dtype=bool)
+_LINE_BREAK[list(b'\n\r')] = True
+
+def _tokens_per_line(data):
+    """
+    Number of whitespace-separated tokens on each line of a label file's raw bytes
+    ASCII data is counted with byte scans; anything else is decoded first (raising for
+    non-UTF-8 files, as reading them in text mode did) and split like str.split()
+    """
+    if not data.isascii():
+        return np.array([len(line.split()) for line in _decode_label(data).split('\n')])
+    
+    buf = np.frombuffer(data, dtype=np.uint8)
+    is_space = _WHITESPACE[buf]
+    
+    # A token starts at a non-space byte that follows a space (or the start of the file)
+    token_start = ~is_space
+    token_start[1:] &= is_space[:-1]
+    
+    line_ids = np.cumsum(_LINE_BREAK[buf])
+    return np.bincount(line_ids[token_start], minlength=int(line_ids[-1]) + 1)
+
 def detect_annotation_type(data_root="cityscapes"):
     """Detect what type of annotations are in the dataset"""
     print("\n🔍 DETECTING ANNOTATION TYPE")
@@ -291,23 +445,17 @@ def detect_annotation_type(data_root="cityscapes"):
         if not label_dir.exists():
             continue
         
-        for label_file in label_dir.glob('*.txt'):
+        for label_file in _list_label_files(label_dir):
             try:
-                with open(label_file, 'r') as f:
-                    lines = f.readlines()
+                data = _read_label(label_file)
                 
-                if not lines:
+                if not data:
                     continue
                 
-                has_bbox = False
-                has_polygon = False
-                
-                for line in lines:
-                    parts = line.strip().split()
-                    if len(parts) == 5:
-                        has_bbox = True
-                    elif len(parts) >= 7 and len(parts) % 2 == 1:
-                        has_polygon = True
+                # Only the token count per line matters - count it with byte scans, no parsing
+                tokens = _tokens_per_line(data)
+                has_bbox = bool((tokens == 5).any())
+                has_polygon = bool(((tokens >= 7) & (tokens % 2 == 1)).any())
                 
                 if has_bbox and has_polygon:
                     mixed_files += 1
@@ -335,24 +483,28 @@ def detect_annotation_type(data_root="cityscapes"):
         print(f"  Use detection model: yolo detect train data=cityscapes/data.yaml model=yolo_models/yolo11n.pt")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fix YOLO label format for a Cityscapes dataset")
+    parser.add_argument("--data-root", default="cityscapes", help="dataset root directory")
+    parser.add_argument("--yes", action="store_true", help="rewrite the label files (otherwise only report)")
+    args = parser.parse_args()
+    
     print("🔧 Cityscapes YOLO Label Format Fixer")
     print("=" * 40)
     
     # Detect annotation type first
-    detect_annotation_type()
+    detect_annotation_type(args.data_root)
     
     # Show example of the problem
     manual_fix_example()
     
     # Check current status
     print("\n🔍 Current status check...")
-    verify_fixed_format()
+    verify_fixed_format(args.data_root)
     
-    # Ask user if they want to fix
-    response = input("\nFix the label format? (y/N): ").lower().strip()
-    if response == 'y':
-        fix_all_labels()
-        verify_fixed_format()
+    # Only rewrite labels when asked to
+    if args.yes:
+        fix_all_labels(args.data_root)
+        verify_fixed_format(args.data_root)
         
         print("\n🎉 Format fixing complete!")
         print("\n💡 TRAINING COMMANDS:")
@@ -361,4 +513,4 @@ if __name__ == "__main__":
         print("\nFor detection (if you have bbox labels):")
         print("yolo detect train data=cityscapes/data.yaml model=yolo11n.pt epochs=150 imgsz=640 batch=16")
     else:
-        print("👋 No changes made.")
\ No newline at end of file
+        print("👋 No changes made - pass --yes to fix the label format.")
\ No newline at end of file
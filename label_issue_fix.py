@@ -5,103 +5,176 @@ Identifies and handles empty label files in YOLO dataset
 """
 
 import os
+import contextlib
+from dataclasses import dataclass
 from pathlib import Path
 
-def analyze_empty_labels(data_root="cityscapes"):
-    """Analyze empty label files in the dataset"""
+import numpy as np
+
+from dataset_utils import CANONICAL_FILE, ROW_CLASS_ID, DatasetIndex, map_parallel
+
+# Per-file remove/move messages are printed in batches of this many lines
+LOG_BATCH = 500
+
+def _stem(path):
+    """File name without its extension"""
+    return os.path.splitext(os.path.basename(path))[0]
+
+def _flush_log(log):
+    """Print buffered per-file messages in one write and empty the buffer"""
+    if log:
+        print("\n".join(log))
+        log.clear()
+
+def _read_small(path):
+    """
+    Text of a small label file via os.open/os.read - no buffered file object
+    Decodes and translates newlines like open(path, 'r') so results don't change
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.read(fd, 1 << 16)
+        if len(data) == 1 << 16:  # large polygon file - read the rest
+            data += b''.join(iter(lambda: os.read(fd, 1 << 16), b''))
+    finally:
+        os.close(fd)
+    
+    text = data.decode()
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+def _is_valid_content(content):
+    """
+    Check every non-empty line: bbox (5 parts) or polygon (odd number >= 7), 40 classes, normalized coords
+    Files made only of canonical rows with class IDs below 40 are accepted with regex
+    matches; class IDs and coordinates of any other file are validated as NumPy arrays
+    """
+    if CANONICAL_FILE.fullmatch(content) and all(int(c) < 40 for c in ROW_CLASS_ID.findall(content)):
+        return True
+    
+    rows = [line.split() for line in content.split('\n') if line.strip()]  # Skip empty lines
+    if not all(len(parts) == 5 or (len(parts) >= 7 and len(parts) % 2 == 1) for parts in rows):
+        return False
+    
+    try:
+        class_ids = np.array([int(parts[0]) for parts in rows], dtype=np.int64)
+        coords = np.array([c for parts in rows for c in parts[1:]], dtype=np.float64)
+    except (ValueError, OverflowError):  # unparsable, or a class ID far outside 0-39
+        return False
+    
+    if ((class_ids < 0) | (class_ids >= 40)).any():  # 40 classes (0-39)
+        return False
+    return not ((coords < 0) | (coords > 1)).any()
+
+def _inspect_label(label_file):
+    """
+    Classify a label file as 'empty', 'valid', 'corrupted' or 'unreadable' and count its annotations
+    Returns (status, error, bbox_count, polygon_count) - error is only set for unreadable files
+    """
+    try:
+        content = _read_small(label_file).strip()
+    except Exception as e:
+        return "unreadable", str(e), 0, 0
+    
+    if not content:
+        return "empty", None, 0, 0
+    
+    bbox_count = 0
+    polygon_count = 0
+    for line in content.split('\n'):
+        if line.strip():
+            parts = line.strip().split()
+            if len(parts) == 5:
+                bbox_count += 1
+            elif len(parts) >= 7 and len(parts) % 2 == 1:
+                polygon_count += 1
+    
+    status = "valid" if _is_valid_content(content) else "corrupted"
+    return status, None, bbox_count, polygon_count
+
+def _scan_split(label_files):
+    """Inspect label files - list of (path, status, error, bbox_count, polygon_count) in input order"""
+    label_files = [str(label_file) for label_file in label_files]
+    
+    # Zero-byte files are empty without opening them - only the rest are read
+    # (a file that can't be stat'ed is read, so it is reported as unreadable)
+    sizes = {}
+    for label_file in label_files:
+        with contextlib.suppress(OSError):
+            sizes[label_file] = os.path.getsize(label_file)
+    to_read = [label_file for label_file in label_files if sizes.get(label_file) != 0]
+    
+    results = dict(zip(to_read, map_parallel(_inspect_label, to_read, chunksize=256)))
+    return [(label_file, *results.get(label_file, ("empty", None, 0, 0))) for label_file in label_files]
+
+@dataclass
+class DatasetReport:
+    """Dataset index plus the label scan of every split - shared by the analysis, the fixes and the verification"""
+    data_path: Path
+    index: DatasetIndex
+    scans: dict  # {split: _scan_split result}, None for splits without a label directory
+
+def scan_dataset(data_root="cityscapes"):
+    """Index every split once and read each label file once"""
+    index = DatasetIndex.build(data_root)
+    scans = {}
+    for split in ['train', 'val', 'test']:
+        labels = index.split(split).labels
+        scans[split] = _scan_split(labels.values()) if labels is not None else None
+    return DatasetReport(Path(data_root), index, scans)
+
+def analyze_empty_labels(data_root="cityscapes", report=None):
+    """
+    Analyze empty label files in the dataset
+    Returns the DatasetReport (scanned here unless given) so fixes can reuse it,
+    or None if the dataset directories are missing
+    """
     print("🔍 Analyzing Cityscapes Label Files")
     print("=" * 40)
     
-    data_path = Path(data_root)
+    data_path = Path(data_root) if report is None else report.data_path
     labels_dir = data_path / 'labels'
     images_dir = data_path / 'images'
     
     if not labels_dir.exists():
         print(f"❌ Labels directory not found: {labels_dir}")
-        return False
+        return None
     
     if not images_dir.exists():
         print(f"❌ Images directory not found: {images_dir}")
-        return False
+        return None
+    
+    if report is None:
+        report = scan_dataset(data_root)
     
     total_empty = 0
     total_valid = 0
     total_corrupted = 0
     
-    for split in ['train', 'val', 'test']:
+    for split, scan in report.scans.items():
         print(f"\n📊 {split.upper()} SET:")
         print("-" * 20)
         
-        label_dir = labels_dir / split
-        if not label_dir.exists():
-            print(f"❌ Labels directory not found: {label_dir}")
+        if scan is None:
+            print(f"❌ Labels directory not found: {report.index.split(split).label_dir}")
             continue
         
-        label_files = list(label_dir.glob('*.txt'))
         empty_files = []
         valid_files = []
         corrupted_files = []
         
-        for label_file in label_files:
-            try:
-                with open(label_file, 'r') as f:
-                    content = f.read().strip()
-                    
-                if not content:
-                    empty_files.append(label_file)
-                else:
-                    # Check if content is valid
-                    lines = content.split('\n')
-                    is_valid = True
-                    
-                    for line in lines:
-                        if line.strip():  # Skip empty lines
-                            parts = line.strip().split()
-                            
-                            # Check bounding box format (5 parts)
-                            if len(parts) == 5:
-                                try:
-                                    class_id = int(parts[0])
-                                    coords = [float(x) for x in parts[1:]]
-                                    if class_id < 0 or class_id >= 40:  # 40 classes (0-39)
-                                        is_valid = False
-                                        break
-                                    if any(c < 0 or c > 1 for c in coords):
-                                        is_valid = False
-                                        break
-                                except ValueError:
-                                    is_valid = False
-                                    break
-                            
-                            # Check polygon segmentation format (odd number >= 7)
-                            elif len(parts) >= 7 and len(parts) % 2 == 1:
-                                try:
-                                    class_id = int(parts[0])
-                                    coords = [float(x) for x in parts[1:]]
-                                    if class_id < 0 or class_id >= 40:  # 40 classes (0-39)
-                                        is_valid = False
-                                        break
-                                    if any(c < 0 or c > 1 for c in coords):
-                                        is_valid = False
-                                        break
-                                except ValueError:
-                                    is_valid = False
-                                    break
-                            
-                            else:
-                                is_valid = False
-                                break
-                    
-                    if is_valid:
-                        valid_files.append(label_file)
-                    else:
-                        corrupted_files.append(label_file)
-                        
-            except Exception as e:
-                print(f"Error reading {label_file.name}: {e}")
+        for label_file, status, error, _, _ in scan:
+            if status == "empty":
+                empty_files.append(label_file)
+            elif status == "valid":
+                valid_files.append(label_file)
+            else:
+                if status == "unreadable":
+                    print(f"Error reading {os.path.basename(label_file)}: {error}")
                 corrupted_files.append(label_file)
         
-        print(f"Total label files: {len(label_files)}")
+        print(f"Total label files: {len(scan)}")
         print(f"✅ Valid labels: {len(valid_files)}")
         print(f"❌ Empty labels: {len(empty_files)}")
         print(f"⚠️  Corrupted labels: {len(corrupted_files)}")
@@ -112,93 +185,51 @@ def analyze_empty_labels(data_root="cityscapes"):
         
         # Show examples
         if empty_files:
-            print(f"Empty files examples: {[f.name for f in empty_files[:5]]}")
+            print(f"Empty files examples: {[os.path.basename(f) for f in empty_files[:5]]}")
         if corrupted_files:
-            print(f"Corrupted files examples: {[f.name for f in corrupted_files[:5]]}")
+            print(f"Corrupted files examples: {[os.path.basename(f) for f in corrupted_files[:5]]}")
     
     print(f"\n📈 SUMMARY:")
     print(f"Total valid labels: {total_valid}")
     print(f"Total empty labels: {total_empty}")
     print(f"Total corrupted labels: {total_corrupted}")
     
-    return total_empty > 0 or total_corrupted > 0
+    return report
 
-def fix_empty_labels(data_root="cityscapes", action="remove"):
+def fix_empty_labels(data_root="cityscapes", action="remove", report=None):
     """
     Fix empty label files
     Actions:
     - 'remove': Remove empty label files and corresponding images
     - 'skip': Keep empty files but move images to separate folder
     - 'manual': List empty files for manual review
+    report: DatasetReport from analyze_empty_labels (scanned here unless given) - it is
+    updated in place to match the files left after removing or moving
     """
     print(f"\n🔧 Fixing Empty Labels (Action: {action})")
     print("=" * 40)
     
-    data_path = Path(data_root)
-    labels_dir = data_path / 'labels'
-    images_dir = data_path / 'images'
+    if report is None:
+        report = scan_dataset(data_root)
+    data_path = report.data_path
     
-    for split in ['train', 'val', 'test']:
-        label_dir = labels_dir / split
-        img_dir = images_dir / split
-        
-        if not label_dir.exists() or not img_dir.exists():
+    for split, scan in report.scans.items():
+        split_index = report.index.split(split)
+        if scan is None or split_index.images is None:
             print(f"❌ Skipping {split} - missing directories")
             continue
         
         print(f"\n{split.upper()} SET:")
         
-        label_files = list(label_dir.glob('*.txt'))
         empty_files = []
         corrupted_files = []
         
-        # Find empty and corrupted files
-        for label_file in label_files:
-            try:
-                with open(label_file, 'r') as f:
-                    content = f.read().strip()
-                
-                if not content:
-                    empty_files.append(label_file)
-                else:
-                    # Check if content is valid
-                    lines = content.split('\n')
-                    is_valid = True
-                    
-                    for line in lines:
-                        if line.strip():  # Skip empty lines
-                            parts = line.strip().split()
-                            
-                            # Valid formats: 5 parts (bbox) or odd number >= 7 (polygon)
-                            if len(parts) == 5:
-                                try:
-                                    class_id = int(parts[0])
-                                    coords = [float(x) for x in parts[1:]]
-                                    if class_id < 0 or class_id >= 40 or any(c < 0 or c > 1 for c in coords):
-                                        is_valid = False
-                                        break
-                                except ValueError:
-                                    is_valid = False
-                                    break
-                            elif len(parts) >= 7 and len(parts) % 2 == 1:
-                                try:
-                                    class_id = int(parts[0])
-                                    coords = [float(x) for x in parts[1:]]
-                                    if class_id < 0 or class_id >= 40 or any(c < 0 or c > 1 for c in coords):
-                                        is_valid = False
-                                        break
-                                except ValueError:
-                                    is_valid = False
-                                    break
-                            else:
-                                is_valid = False
-                                break
-                    
-                    if not is_valid:
-                        corrupted_files.append(label_file)
-                        
-            except Exception:
+        # Find empty and corrupted files (unreadable files are treated as empty)
+        for label_file, status, _, _, _ in scan:
+            if status in ("empty", "unreadable"):
                 empty_files.append(label_file)
+            elif status == "corrupted":
+                corrupted_files.append(label_file)
         
         problematic_files = empty_files + corrupted_files
         print(f"Found {len(empty_files)} empty and {len(corrupted_files)} corrupted label files")
@@ -207,27 +238,35 @@ def fix_empty_labels(data_root="cityscapes", action="remove"):
             print("✅ No problematic files to fix!")
             continue
         
+        # Membership checks below are per file - use a set, not the list
+        empty_set = set(empty_files)
+        img_index = split_index.images
+        
         if action == "remove":
             removed_images = 0
-            for label_file in problematic_files:
-                # Find corresponding image(s)
-                img_name = label_file.stem
-                img_extensions = ['*.png', '*.jpg', '*.jpeg']
-                img_files = []
-                for ext in img_extensions:
-                    img_files.extend(list(img_dir.glob(f"{img_name}.{ext[2:]}")))
-                
-                # Remove label file
-                file_type = "empty" if label_file in empty_files else "corrupted"
-                label_file.unlink()
-                print(f"Removed {file_type} label: {label_file.name}")
-                
-                # Remove corresponding image(s)
-                for img_file in img_files:
-                    img_file.unlink()
-                    print(f"Removed image: {img_file.name}")
-                    removed_images += 1
+            log = []
+            try:
+                for label_file in problematic_files:
+                    # Find corresponding image(s)
+                    img_files = img_index.pop(_stem(label_file), [])
+                    
+                    # Remove label file
+                    file_type = "empty" if label_file in empty_set else "corrupted"
+                    os.unlink(label_file)
+                    log.append(f"Removed {file_type} label: {os.path.basename(label_file)}")
+                    
+                    # Remove corresponding image(s)
+                    for img_file in img_files:
+                        os.unlink(img_file)
+                        log.append(f"Removed image: {os.path.basename(img_file)}")
+                        removed_images += 1
+                    
+                    if len(log) >= LOG_BATCH:
+                        _flush_log(log)
+            finally:
+                _flush_log(log)
             
+            report.scans[split] = [entry for entry in scan if entry[1] == "valid"]
             print(f"✅ Removed {len(problematic_files)} label files and {removed_images} image files")
         
         elif action == "skip":
@@ -239,117 +278,92 @@ def fix_empty_labels(data_root="cityscapes", action="remove"):
             backup_label_dir.mkdir(parents=True, exist_ok=True)
             
             moved_images = 0
-            for label_file in problematic_files:
-                # Move label file
-                file_type = "empty" if label_file in empty_files else "corrupted"
-                dest_label = backup_label_dir / label_file.name
-                label_file.rename(dest_label)
-                print(f"Moved {file_type} label: {label_file.name}")
-                
-                # Move corresponding image(s)
-                img_name = label_file.stem
-                img_extensions = ['*.png', '*.jpg', '*.jpeg']
-                img_files = []
-                for ext in img_extensions:
-                    img_files.extend(list(img_dir.glob(f"{img_name}.{ext[2:]}")))
-                
-                for img_file in img_files:
-                    dest_img = backup_img_dir / img_file.name
-                    img_file.rename(dest_img)
-                    print(f"Moved image: {img_file.name}")
-                    moved_images += 1
+            log = []
+            try:
+                for label_file in problematic_files:
+                    # Move label file
+                    file_type = "empty" if label_file in empty_set else "corrupted"
+                    label_name = os.path.basename(label_file)
+                    os.rename(label_file, os.path.join(backup_label_dir, label_name))
+                    log.append(f"Moved {file_type} label: {label_name}")
+                    
+                    # Move corresponding image(s)
+                    img_files = img_index.pop(_stem(label_file), [])
+                    
+                    for img_file in img_files:
+                        img_name = os.path.basename(img_file)
+                        os.rename(img_file, os.path.join(backup_img_dir, img_name))
+                        log.append(f"Moved image: {img_name}")
+                        moved_images += 1
+                    
+                    if len(log) >= LOG_BATCH:
+                        _flush_log(log)
+            finally:
+                _flush_log(log)
             
+            report.scans[split] = [entry for entry in scan if entry[1] == "valid"]
             print(f"✅ Moved {len(problematic_files)} label files and {moved_images} images to {backup_dir}")
         
         elif action == "manual":
             print("Problematic label files for manual review:")
             for i, label_file in enumerate(problematic_files[:20]):  # Show first 20
-                file_type = "empty" if label_file in empty_files else "corrupted"
-                print(f"  {i+1}. {label_file.name} ({file_type})")
+                file_type = "empty" if label_file in empty_set else "corrupted"
+                print(f"  {i+1}. {os.path.basename(label_file)} ({file_type})")
             if len(problematic_files) > 20:
                 print(f"  ... and {len(problematic_files) - 20} more")
+    
+    return report
 
-def verify_dataset(data_root="cityscapes"):
-    """Verify dataset after fixes"""
+def verify_dataset(data_root="cityscapes", report=None):
+    """Verify dataset after fixes - report is the DatasetReport kept up to date by fix_empty_labels (scanned here unless given)"""
     print(f"\n✅ VERIFICATION AFTER FIXES")
     print("=" * 30)
     
-    data_path = Path(data_root)
-    images_dir = data_path / 'images'
-    labels_dir = data_path / 'labels'
-    
-    if not images_dir.exists() or not labels_dir.exists():
+    data_path = Path(data_root) if report is None else report.data_path
+    if not (data_path / 'images').exists() or not (data_path / 'labels').exists():
         print("❌ Missing main directories")
         return
     
+    if report is None:
+        report = scan_dataset(data_root)
+    
+    # Splits with both an image and a label directory
+    checked = {split: (report.index.split(split).images, scan) for split, scan in report.scans.items()
+               if scan is not None and report.index.split(split).images is not None}
+    
     total_images = 0
     total_labels = 0
     
-    for split in ['train', 'val', 'test']:
-        img_dir = images_dir / split
-        label_dir = labels_dir / split
-        
-        if not img_dir.exists() or not label_dir.exists():
-            continue
-        
+    for split, (images, scan) in checked.items():
         # Count images
-        img_extensions = ['*.png', '*.jpg', '*.jpeg']
-        images = []
-        for ext in img_extensions:
-            images.extend(list(img_dir.glob(ext)))
+        n_images = sum(len(paths) for paths in images.values())
         
-        # Count valid labels
-        labels = list(label_dir.glob('*.txt'))
+        # Count valid labels (every label file with content - empty and unreadable ones count nothing)
         valid_labels = 0
         bbox_annotations = 0
         polygon_annotations = 0
         
-        for label_file in labels:
-            try:
-                with open(label_file, 'r') as f:
-                    content = f.read().strip()
-                if content:
-                    valid_labels += 1
-                    # Count annotation types
-                    lines = content.split('\n')
-                    for line in lines:
-                        if line.strip():
-                            parts = line.strip().split()
-                            if len(parts) == 5:
-                                bbox_annotations += 1
-                            elif len(parts) >= 7 and len(parts) % 2 == 1:
-                                polygon_annotations += 1
-            except Exception:
-                pass
+        for _, status, _, bbox_count, polygon_count in scan:
+            valid_labels += status in ("valid", "corrupted")
+            bbox_annotations += bbox_count
+            polygon_annotations += polygon_count
         
-        print(f"{split.upper()}: {len(images)} images, {valid_labels} valid labels")
+        print(f"{split.upper()}: {n_images} images, {valid_labels} valid labels")
         if bbox_annotations > 0:
             print(f"  └─ {bbox_annotations} bounding box annotations")
         if polygon_annotations > 0:
             print(f"  └─ {polygon_annotations} polygon annotations")
         
-        total_images += len(images)
+        total_images += n_images
         total_labels += valid_labels
     
     print(f"\n📊 TOTAL: {total_images} images, {total_labels} valid labels")
     
     # Check for matching pairs
     print(f"\n🔍 MATCHING CHECK:")
-    for split in ['train', 'val', 'test']:
-        img_dir = images_dir / split
-        label_dir = labels_dir / split
-        
-        if not img_dir.exists() or not label_dir.exists():
-            continue
-        
-        # Get image stems
-        img_extensions = ['*.png', '*.jpg', '*.jpeg']
-        img_stems = set()
-        for ext in img_extensions:
-            img_stems.update([f.stem for f in img_dir.glob(ext)])
-        
-        # Get label stems
-        label_stems = {f.stem for f in label_dir.glob('*.txt')}
+    for split, (images, scan) in checked.items():
+        img_stems = images.keys()
+        label_stems = {_stem(label_file) for label_file, _, _, _, _ in scan}
         
         matched = len(img_stems & label_stems)
         unmatched = len(img_stems - label_stems)
@@ -360,8 +374,10 @@ if __name__ == "__main__":
     print("🔧 Cityscapes Empty Label Files Handler")
     print("=" * 40)
     
-    # Analyze the issue
-    has_issues = analyze_empty_labels()
+    # Analyze the issue - one scan of the dataset is shared by the fixes and the verification
+    report = analyze_empty_labels()
+    has_issues = report is not None and any(
+        status != "valid" for scan in report.scans.values() for _, status, _, _, _ in scan or ())
     
     if has_issues:
         print("\n" + "=" * 50)
@@ -376,17 +392,17 @@ if __name__ == "__main__":
         if choice == "1":
             confirm = input("⚠️  This will DELETE files. Continue? (y/N): ").lower().strip()
             if confirm == 'y':
-                fix_empty_labels(action="remove")
-                verify_dataset()
+                fix_empty_labels(action="remove", report=report)
+                verify_dataset(report=report)
             else:
                 print("Cancelled.")
         elif choice == "2":
-            fix_empty_labels(action="skip")
-            verify_dataset()
+            fix_empty_labels(action="skip", report=report)
+            verify_dataset(report=report)
         elif choice == "3":
-            fix_empty_labels(action="manual")
+            fix_empty_labels(action="manual", report=report)
         else:
             print("👋 Exiting without changes...")
     else:
         print("\n✅ No empty or corrupted label files found. Your dataset should work fine!")
-        verify_dataset()
\ No newline at end of file
+        verify_dataset(report=report)
@@ -4,11 +4,32 @@ Convert segmentation masks to YOLO bounding box format
 Converts colored PNG masks to .txt files with bounding boxes
 """
 
+import os
+import argparse
+import queue
+import shutil
+import threading
 import cv2
 import numpy as np
 from pathlib import Path
 import json
 from collections import defaultdict
+from functools import lru_cache
+
+from dataset_utils import PARALLEL_MIN_FILES, map_parallel
+
+# Pillow (installed with ultralytics) reads paletted PNGs as one index per pixel
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Masks per worker task, and how many decoded masks / box lists may wait between pipeline stages
+MASK_BATCH = 32
+PIPELINE_DEPTH = 8
+
+# One YOLO label row: class x_center y_center width height
+YOLO_ROW = b"%d %.6f %.6f %.6f %.6f\n"
 
 # Your 19-class mapping (adjust colors based on your actual mask colors)
 CLASS_MAPPING = {
@@ -33,30 +54,106 @@ CLASS_MAPPING = {
     18: "bicycle"       
 }
 
-def analyze_mask_colors(mask_dir, sample_size=10):
+def _iter_files(directory, exts):
+    """Paths (as plain strings) of the files in directory ending with exts - one os.scandir pass"""
+    with os.scandir(directory) as it:
+        return [e.path for e in it if e.is_file() and e.name.endswith(exts)]
+
+def _mask_cache_path(mask_path):
+    """Path of a mask's decoded .npy cache entry - in a .cache folder beside the PNG"""
+    mask_dir, name = os.path.split(str(mask_path))
+    return os.path.join(mask_dir, '.cache', os.path.splitext(name)[0] + '.npy')
+
+def _load_cached_mask(mask_path):
+    """Memory-mapped decoded mask from the cache, or None unless an entry newer than the PNG exists"""
+    npy_path = _mask_cache_path(mask_path)
+    try:
+        if os.stat(npy_path).st_mtime_ns >= os.stat(mask_path).st_mtime_ns:
+            return np.load(npy_path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _drop_cached_mask(mask_path):
+    """Remove a mask's cache entry once the mask has been consumed"""
+    try:
+        os.unlink(_mask_cache_path(mask_path))
+    except OSError:
+        pass
+
+def _load_mask(mask_path, cache=False):
+    """
+    Decode a mask with cv2.imread
+    With cache=True the decoded array is also saved to the mask's cache entry (or read from
+    it while it is newer than the PNG), so the conversion after the color analysis skips the decode
+    """
+    if not cache:
+        return cv2.imread(str(mask_path))
+    
+    mask = _load_cached_mask(mask_path)
+    if mask is not None:
+        return mask
+    
+    mask = cv2.imread(str(mask_path))
+    if mask is not None:
+        try:
+            npy_path = _mask_cache_path(mask_path)
+            os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+            np.save(npy_path, mask)
+        except OSError:
+            pass
+    return mask
+
+def _load_palette_indices(mask_path):
+    """
+    (indices, palette) for a paletted ('P' mode) PNG - None for any other mask or without Pillow
+    indices is the 2-D uint8 array as stored, palette the 256 packed BGR colors it points to
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(mask_path) as im:
+            if im.mode != 'P':
+                return None
+            indices = np.asarray(im)
+            rgb = np.zeros((256, 3), dtype=np.uint8)
+            colors = np.frombuffer(bytes(im.getpalette('RGB')), dtype=np.uint8).reshape(-1, 3)[:256]
+            rgb[:len(colors)] = colors
+    except Exception:
+        return None
+    return indices, _pack_colors(rgb[:, ::-1])
+
+def _pack_colors(mask):
+    """Pack a BGR mask into one uint32 per pixel (B << 16 | G << 8 | R) - sorts like the BGR tuples"""
+    return (mask[..., 0].astype(np.uint32) << 16) | (mask[..., 1].astype(np.uint32) << 8) | mask[..., 2]
+
+def _unpack_colors(packed):
+    """(B, G, R) tuples of Python ints for a 1-D array of packed colors"""
+    return list(zip((packed >> 16).tolist(), ((packed >> 8) & 0xFF).tolist(), (packed & 0xFF).tolist()))
+
+def analyze_mask_colors(mask_dir, sample_size=10, cache=False):
     """Analyze unique colors in mask files to create color mapping"""
     print("🎨 Analyzing mask colors...")
     
-    mask_files = list(Path(mask_dir).glob("*.png"))[:sample_size]
-    all_colors = set()
+    mask_files = _iter_files(mask_dir, ('.png',))[:sample_size]
+    packed_colors = [np.empty(0, dtype=np.uint32)]
     
     for mask_file in mask_files:
-        mask = cv2.imread(str(mask_file))
+        mask = _load_mask(mask_file, cache)
         if mask is None:
             continue
             
-        # Get unique colors
-        mask_reshaped = mask.reshape(-1, 3)
-        unique_colors = np.unique(mask_reshaped, axis=0)
-        
-        for color in unique_colors:
-            all_colors.add(tuple(color))
+        # Get unique colors - integer unique on packed pixels, not a row-wise axis=0 unique
+        packed_colors.append(np.unique(_pack_colors(mask)))
+    
+    # One sorted union of every file's colors - packed order is sorted BGR tuple order
+    all_colors = _unpack_colors(np.unique(np.concatenate(packed_colors)))
     
     print(f"Found {len(all_colors)} unique colors:")
-    for i, color in enumerate(sorted(all_colors)):
+    for i, color in enumerate(all_colors):
         print(f"  Color {i}: RGB{color} -> BGR{color[::-1]}")
     
-    return sorted(all_colors)
+    return all_colors
 
 def create_color_to_class_mapping():
     """Create mapping from colors to class IDs - CUSTOMIZE THIS"""
@@ -84,71 +181,197 @@ def create_color_to_class_mapping():
     }
     return color_to_class
 
-def find_closest_color(target_color, color_mapping, threshold=50):
-    """Find closest color in mapping"""
-    min_distance = float('inf')
-    closest_class = None
-    
-    for color, class_id in color_mapping.items():
-        # Calculate Euclidean distance
-        distance = np.sqrt(sum((a - b) ** 2 for a, b in zip(target_color, color)))
-        if distance < min_distance and distance < threshold:
-            min_distance = distance
-            closest_class = class_id
-    
-    return closest_class
+@lru_cache(maxsize=4)
+def _class_lut(palette_items, threshold):
+    """
+    Lookup table from every packed BGR color (see _pack_colors) to the class ID of the
+    closest palette color within threshold (255 = no class)
+    Built once by flooding a sphere of offsets around each palette color; ties go to the
+    earlier palette entry, like a first-minimum nearest-neighbour search
+    """
+    lut = np.full(1 << 24, 255, dtype=np.uint8)
+    best = np.full(1 << 24, np.iinfo(np.uint32).max, dtype=np.uint32)
+    
+    # Integer offsets strictly closer than threshold
+    radius = int(np.ceil(threshold)) - 1
+    steps = np.arange(-radius, radius + 1)
+    db, dg, dr = (d.ravel() for d in np.meshgrid(steps, steps, steps, indexing='ij'))
+    dist2 = db * db + dg * dg + dr * dr
+    keep = dist2 < threshold ** 2
+    db, dg, dr, dist2 = db[keep], dg[keep], dr[keep], dist2[keep].astype(np.uint32)
+    
+    for (b, g, r), class_id in palette_items:
+        cb, cg, cr = b + db, g + dg, r + dr
+        valid = (cb >= 0) & (cb <= 255) & (cg >= 0) & (cg <= 255) & (cr >= 0) & (cr <= 255)
+        index = (cb[valid] << 16) | (cg[valid] << 8) | cr[valid]
+        candidate = dist2[valid]
+        
+        closer = candidate < best[index]
+        best[index[closer]] = candidate[closer]
+        lut[index[closer]] = class_id
+    
+    return lut
 
-def mask_to_bounding_boxes(mask_path, color_to_class, use_closest_color=True):
-    """Convert segmentation mask to bounding boxes"""
-    mask = cv2.imread(str(mask_path))
+def _load_class_map(mask_path, lut, cache=False):
+    """
+    Per-pixel class IDs of a mask (255 = no class) through a _class_lut table - None if unreadable
+    With cache=True a cache entry left by the color analysis is used first; nothing new is cached here
+    """
+    mask = _load_cached_mask(mask_path) if cache else None
     if mask is None:
+        # Paletted masks only need their 256 palette colors mapped, then one index per pixel
+        indexed = _load_palette_indices(mask_path)
+        if indexed is not None:
+            indices, palette = indexed
+            return lut[palette][indices]
+        
+        mask = cv2.imread(str(mask_path))
+        if mask is None:
+            return None
+    return lut[_pack_colors(mask)]
+
+def mask_to_bounding_boxes(mask_path, color_to_class, use_closest_color=True, cache=False):
+    """Convert segmentation mask to bounding boxes"""
+    # Color -> class table on packed colors (255 = no class) - an exact match is
+    # distance 0, so without closest-color matching only distances below 1 count
+    lut = _class_lut(tuple(color_to_class.items()), 50 if use_closest_color else 1)
+    return _class_map_to_bboxes(_load_class_map(mask_path, lut, cache))
+
+def _class_map_to_bboxes(class_map):
+    """YOLO boxes [class, x_center, y_center, width, height] of every object in a class map"""
+    if class_map is None:
         return []
     
-    height, width = mask.shape[:2]
+    height, width = class_map.shape[:2]
+    scale = np.array([width, height, width, height], dtype=np.float64)
     bboxes = []
     
-    # Get unique colors in the mask
-    mask_reshaped = mask.reshape(-1, 3)
-    unique_colors = np.unique(mask_reshaped, axis=0)
-    
-    for color in unique_colors:
-        color_tuple = tuple(color)
-        
-        # Find class ID for this color
-        class_id = None
-        if color_tuple in color_to_class:
-            class_id = color_to_class[color_tuple]
-        elif use_closest_color:
-            class_id = find_closest_color(color_tuple, color_to_class)
+    class_counts = np.bincount(class_map.ravel(), minlength=256)
+    for class_id in np.flatnonzero(class_counts[:255]).tolist():
+        # One connected-components pass per class gives every object's box and pixel area
+        _, _, stats, _ = cv2.connectedComponentsWithStats((class_map == class_id).view(np.uint8), connectivity=8)
         
-        if class_id is None:
+        stats = stats[1:]  # component 0 is the background
+        stats = stats[stats[:, cv2.CC_STAT_AREA] >= 50]  # Skip very small objects
+        if not len(stats):
             continue
         
-        # Create binary mask for this color
-        binary_mask = np.all(mask == color, axis=2).astype(np.uint8)
+        # Convert to YOLO format (normalized coordinates) for all of the class's boxes at once
+        boxes = stats[:, :4].astype(np.float64)
+        boxes[:, :2] += boxes[:, 2:] / 2
+        boxes /= scale
         
-        # Find contours
-        contours, _ = cv2.findContours(binary_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        for contour in contours:
-            if cv2.contourArea(contour) < 50:  # Skip very small objects
-                continue
-                
-            # Get bounding box
-            x, y, w, h = cv2.boundingRect(contour)
-            
-            # Convert to YOLO format (normalized coordinates)
-            x_center = (x + w / 2) / width
-            y_center = (y + h / 2) / height
-            box_width = w / width
-            box_height = h / height
-            
-            bboxes.append([class_id, x_center, y_center, box_width, box_height])
+        bboxes.extend([class_id, *box] for box in boxes.tolist())
     
     return bboxes
 
-def convert_dataset(data_root="data", create_backup=True):
-    """Convert entire dataset from masks to YOLO format"""
+# Color mapping for worker processes - sent once per worker by the pool initializer
+_worker_color_to_class = None
+
+def _init_worker(color_to_class):
+    """Pool initializer: keep the color mapping in the worker's module state"""
+    global _worker_color_to_class
+    _worker_color_to_class = color_to_class
+
+def _write_label(mask_file, bboxes, backup_dir):
+    """Write a mask's boxes as its YOLO .txt label, backing up (or deleting) the mask - nothing if no boxes"""
+    if not bboxes:
+        return
+    
+    # Create .txt file
+    txt_file = os.path.splitext(mask_file)[0] + '.txt'
+    
+    # Backup original mask
+    if backup_dir is not None:
+        backup_file = backup_dir / os.path.basename(mask_file)
+        if not backup_file.exists():
+            os.rename(mask_file, backup_file)
+    else:
+        os.unlink(mask_file)  # Delete original mask
+    
+    # Write YOLO format - all rows formatted into one buffer, written with one syscall
+    data = b"".join(YOLO_ROW % tuple(bbox) for bbox in bboxes)
+    fd = os.open(txt_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+def _convert_batch(jobs):
+    """
+    Convert (mask_file, backup_dir, cache) jobs to YOLO labels - list of (num_bboxes, error) in input order
+    Decoding, box extraction and writing run as a three-stage thread pipeline joined by
+    bounded queues, so PNG decode and file I/O (which release the GIL) overlap the box math
+    """
+    lut = _class_lut(tuple(_worker_color_to_class.items()), 50)
+    decoded = queue.Queue(maxsize=PIPELINE_DEPTH)
+    extracted = queue.Queue(maxsize=PIPELINE_DEPTH)
+    results = [None] * len(jobs)
+    
+    def read():
+        for i, (mask_file, _, cache) in enumerate(jobs):
+            try:
+                decoded.put((i, _load_class_map(mask_file, lut, cache), None))
+            except Exception as e:
+                decoded.put((i, None, str(e)))
+        decoded.put(None)
+    
+    def write():
+        for i, bboxes, error in iter(extracted.get, None):
+            mask_file, backup_dir, cache = jobs[i]
+            if error is None:
+                try:
+                    _write_label(mask_file, bboxes, backup_dir)
+                except Exception as e:
+                    error = str(e)
+            
+            # The mask has been consumed, with or without boxes - its cache entry is no longer needed
+            if cache:
+                _drop_cached_mask(mask_file)
+            results[i] = (0, error) if error is not None else (len(bboxes), None)
+    
+    reader = threading.Thread(target=read, daemon=True)
+    writer = threading.Thread(target=write, daemon=True)
+    reader.start()
+    writer.start()
+    
+    # Box extraction runs on this thread, between the reader and the writer
+    for i, class_map, error in iter(decoded.get, None):
+        bboxes = []
+        if error is None:
+            try:
+                bboxes = _class_map_to_bboxes(class_map)
+            except Exception as e:
+                error = str(e)
+        extracted.put((i, bboxes, error))
+    extracted.put(None)
+    
+    reader.join()
+    writer.join()
+    return results
+
+def _convert_masks(mask_files, color_to_class, backup_dir, cache=False):
+    """List of (num_bboxes, error) per mask in input order, using worker processes for large batches"""
+    jobs = [(mask_file, backup_dir, cache) for mask_file in mask_files]
+    
+    if len(jobs) < PARALLEL_MIN_FILES:
+        _init_worker(color_to_class)
+        return _convert_batch(jobs)
+    
+    # Build the color table before starting workers so forked processes inherit it
+    _class_lut(tuple(color_to_class.items()), 50)
+    
+    # Each worker runs the decode/extract/write pipeline over one batch of masks at a time
+    batches = [jobs[i:i + MASK_BATCH] for i in range(0, len(jobs), MASK_BATCH)]
+    batch_results = map_parallel(_convert_batch, batches, initializer=_init_worker,
+                                 initargs=(color_to_class,), min_items=1)
+    return [result for results in batch_results for result in results]
+
+def convert_dataset(data_root="data", create_backup=True, cache=False):
+    """
+    Convert entire dataset from masks to YOLO format
+    cache: reuse masks decoded by the color analysis (.npy under .cache/) for their conversion
+    """
     print("🔄 Converting segmentation masks to YOLO format")
     print("=" * 50)
     
@@ -160,13 +383,13 @@ def convert_dataset(data_root="data", create_backup=True):
     for split in ['train', 'val']:
         label_dir = data_path / split / 'labels'
         if label_dir.exists():
-            mask_files = list(label_dir.glob("*.png"))
+            mask_files = _iter_files(label_dir, ('.png',))
             if mask_files:
                 sample_mask_dir = label_dir
                 break
     
     if sample_mask_dir:
-        unique_colors = analyze_mask_colors(sample_mask_dir)
+        unique_colors = analyze_mask_colors(sample_mask_dir, cache=cache)
         print(f"\n📋 Update color mapping in the script if needed!")
         
         # Suggest color mapping
@@ -187,53 +410,37 @@ def convert_dataset(data_root="data", create_backup=True):
             continue
         
         # Create backup of original masks
+        backup_dir = None
         if create_backup:
             backup_dir = label_dir.parent / f"labels_masks_backup"
             backup_dir.mkdir(exist_ok=True)
         
         # Get all PNG mask files
-        mask_files = list(label_dir.glob("*.png"))
+        mask_files = _iter_files(label_dir, ('.png',))
         print(f"Found {len(mask_files)} mask files")
         
         converted = 0
         skipped = 0
         
-        for mask_file in mask_files:
-            try:
-                # Convert mask to bounding boxes
-                bboxes = mask_to_bounding_boxes(mask_file, color_to_class)
-                
-                if bboxes:
-                    # Create .txt file
-                    txt_file = mask_file.with_suffix('.txt')
-                    
-                    # Backup original mask
-                    if create_backup:
-                        backup_file = backup_dir / mask_file.name
-                        if not backup_file.exists():
-                            mask_file.rename(backup_file)
-                    else:
-                        mask_file.unlink()  # Delete original mask
-                    
-                    # Write YOLO format
-                    with open(txt_file, 'w') as f:
-                        for bbox in bboxes:
-                            f.write(f"{bbox[0]} {bbox[1]:.6f} {bbox[2]:.6f} {bbox[3]:.6f} {bbox[4]:.6f}\\n")
-                    
-                    converted += 1
-                    conversion_stats[f"{split}_converted"] += 1
-                    conversion_stats[f"{split}_objects"] += len(bboxes)
-                else:
-                    print(f"⚠️  No objects found in {mask_file.name}")
-                    skipped += 1
-                    
-            except Exception as e:
-                print(f"❌ Error converting {mask_file.name}: {e}")
+        for mask_file, (num_bboxes, error) in zip(mask_files, _convert_masks(mask_files, color_to_class, backup_dir, cache)):
+            if error is not None:
+                print(f"❌ Error converting {os.path.basename(mask_file)}: {error}")
+                skipped += 1
+            elif num_bboxes:
+                converted += 1
+                conversion_stats[f"{split}_converted"] += 1
+                conversion_stats[f"{split}_objects"] += num_bboxes
+            else:
+                print(f"⚠️  No objects found in {os.path.basename(mask_file)}")
                 skipped += 1
         
         print(f"✅ Converted: {converted} files")
         print(f"⚠️  Skipped: {skipped} files")
     
+    # Cache entries only live for one run - drop any the conversion didn't consume
+    if cache and sample_mask_dir:
+        shutil.rmtree(sample_mask_dir / '.cache', ignore_errors=True)
+    
     # Print summary
     print(f"\n📊 CONVERSION SUMMARY:")
     for key, value in conversion_stats.items():
@@ -253,9 +460,9 @@ def verify_conversion(data_root="data"):
         if not img_dir.exists() or not label_dir.exists():
             continue
         
-        images = list(img_dir.glob('*.png')) + list(img_dir.glob('*.jpg'))
-        txt_labels = list(label_dir.glob('*.txt'))
-        png_masks = list(label_dir.glob('*.png'))
+        images = _iter_files(img_dir, ('.png', '.jpg'))
+        txt_labels = _iter_files(label_dir, ('.txt',))
+        png_masks = _iter_files(label_dir, ('.png',))
         
         # Count non-empty labels
         valid_labels = 0
@@ -264,7 +471,7 @@ def verify_conversion(data_root="data"):
         for label_file in txt_labels:
             try:
                 with open(label_file, 'r') as f:
-                    lines = f.read().strip().split('\\n')
+                    lines = f.read().strip().split('\n')
                     if lines and lines[0]:
                         valid_labels += 1
                         total_objects += len([l for l in lines if l.strip()])
@@ -278,6 +485,11 @@ def verify_conversion(data_root="data"):
         print(f"  Total objects: {total_objects}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert segmentation masks to YOLO bounding box labels")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep masks decoded by the color analysis under .cache/ so their conversion skips PNG decoding")
+    args = parser.parse_args()
+    
     print("🎭 Segmentation Mask to YOLO Converter")
     print("=" * 40)
     
@@ -288,7 +500,7 @@ if __name__ == "__main__":
     for split in ['train', 'val']:
         label_dir = data_path / split / 'labels'
         if label_dir.exists():
-            masks = list(label_dir.glob("*.png"))
+            masks = _iter_files(label_dir, ('.png',))
             if masks:
                 has_masks = True
                 print(f"Found {len(masks)} mask files in {split}/labels/")
@@ -300,15 +512,15 @@ if __name__ == "__main__":
         print("  - data/val/labels/*.png")
         exit(1)
     
-    print("\\n⚠️  IMPORTANT: Review the color mapping in create_color_to_class_mapping()")
+    print("\n⚠️  IMPORTANT: Review the color mapping in create_color_to_class_mapping()")
     print("Update the colors to match your actual mask colors!")
     
-    response = input("\\nContinue with conversion? (y/N): ").lower().strip()
+    response = input("\nContinue with conversion? (y/N): ").lower().strip()
     if response == 'y':
-        convert_dataset()
+        convert_dataset(cache=args.cache)
         verify_conversion()
         
-        print("\\n🎉 Conversion complete!")
+        print("\n🎉 Conversion complete!")
         print("You can now train with: yolo detect train data=data/data.yaml model=yolo11n.pt ...")
     else:
         print("👋 Cancelled. Update the color mapping first!")
\ No newline at end of file
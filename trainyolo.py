@@ -1,14 +1,23 @@
 # Training with YOLOv11 using all Cityscapes classes
+import os
 from ultralytics import YOLO
+from ultralytics.cfg import DEFAULT_CFG_DICT
 
 # Load model
 model = YOLO('yolo11n.pt')
 
+# torch.compile is only a train argument on recent ultralytics releases
+compile_args = {'compile': True} if 'compile' in DEFAULT_CFG_DICT else {}
+
 # Train with all 19 Cityscapes classes using your folder structure
 results = model.train(
     data='cityscapes_dataset.yaml',
     epochs=100,
     imgsz=640,
     batch=16,
-    name='cityscapes_yolo'
-)
\ No newline at end of file
+    name='cityscapes_yolo',
+    amp=True,  # mixed precision
+    cache='ram',  # decode images once - ultralytics skips caching if RAM is short (use 'disk' then)
+    workers=min(16, os.cpu_count() or 1),
+    **compile_args
+)